@@ -0,0 +1,325 @@
+/*!
+ * \file qsketch.c
+ *
+ * \brief Quantile sketch implementation
+ *
+ * \implementation
+ * The quantile sketch is a stack of "compactors" in the style of Karnin, Lang
+ * and Liberty (KLL).  Every level holds up to QS_K values, and a value stored
+ * at level h stands for 2^h values of the input.  New values go to level 0.
+ * When a level fills up, it is sorted and every other value (starting from a
+ * randomly chosen offset) moves one level up, where it counts twice as much;
+ * the rest is discarded.  The total weight of the sketch is therefore always
+ * exactly the number of values inserted, and each compaction shifts the rank
+ * of any value by at most the weight of the level.
+ *
+ * For n values the sketch keeps log2(n / QS_K) + 1 levels, so its size grows
+ * only logarithmically with n, and two sketches merge by pushing the values of
+ * one into the levels of the other.  As long as fewer than QS_K values were
+ * inserted nothing is discarded and the quantiles are exact.
+ *
+ * Quantiles are interpolated between stored values in the same way as
+ * <c>percentile_cont</c>, where each value of weight w covers w consecutive
+ * ranks.
+ */
+
+#include <postgres.h>
+#include <utils/array.h>
+#include <utils/elog.h>
+#include <utils/builtins.h>
+#include <nodes/execnodes.h>
+#include <fmgr.h>
+#include <catalog/pg_type.h>
+#include <math.h>
+#include <stddef.h>
+
+#define QS_K 1024          /* magic tuning value: capacity of a level, must be even */
+#define QS_MAXLEVELS 48    /* enough for QS_K * 2^47 values */
+
+/*!
+ * \internal
+ * \brief the transition value struct for quantile sketches
+ *
+ * The values of each level are stored one level after the other, QS_K slots
+ * per level, and the struct grows by one level at a time.
+ * \endinternal
+ */
+typedef struct {
+    int64  n;                       /*! number of values inserted */
+    uint32 nlevels;                 /*! number of levels allocated */
+    uint32 seed;                    /*! state of the generator of compaction offsets */
+    uint32 sizes[QS_MAXLEVELS];     /*! number of values held at each level */
+    float8 values[1];               /*! the values, QS_K slots per level */
+} qstransval;
+
+#define QS_TRANSVAL_SZ(nlevels) \
+    (VARHDRSZ + offsetof(qstransval, values) + (nlevels)*QS_K*sizeof(float8))
+#define QS_TRANSVAL_INITIALIZED(t) (VARSIZE(t) >= QS_TRANSVAL_SZ(1))
+#define QS_TRANSVAL(t) ((qstransval *)VARDATA(t))
+#define QS_LEVEL(transval, level) ((transval)->values + (level)*QS_K)
+
+/*! a value of the sketch with the number of input values it stands for */
+typedef struct {
+    float8 value;
+    int64  weight;
+} qsitem;
+
+Datum __qsketch_trans(PG_FUNCTION_ARGS);
+Datum __qsketch_merge(PG_FUNCTION_ARGS);
+Datum qsketch_quantiles(PG_FUNCTION_ARGS);
+bytea *qsketch_init_transval(void);
+bytea *qsketch_insert(bytea *, float8, uint32);
+bytea *qsketch_merge_c(bytea *, bytea *);
+void check_qstransval(bytea *);
+
+/*! order float8 values, with NaN after everything else as Postgres does */
+static int float8_cmp(const void *a, const void *b)
+{
+    float8 x = *(const float8 *)a;
+    float8 y = *(const float8 *)b;
+
+    if (isnan(x))
+        return isnan(y) ? 0 : 1;
+    if (isnan(y))
+        return -1;
+    return (x > y) - (x < y);
+}
+
+static int qsitem_cmp(const void *a, const void *b)
+{
+    return float8_cmp(&((const qsitem *)a)->value, &((const qsitem *)b)->value);
+}
+
+PG_FUNCTION_INFO_V1(__qsketch_trans);
+
+/*! UDA transition function for the qsketch aggregate. */
+Datum __qsketch_trans(PG_FUNCTION_ARGS)
+{
+    bytea *transblob = PG_GETARG_BYTEA_P(0);
+
+    /*
+     * This function makes destructive updates to its arguments.
+     * Make sure it's being called in an agg context.
+     */
+    if (!(fcinfo->context &&
+          (IsA(fcinfo->context, AggState)
+    #ifdef NOTGP
+           || IsA(fcinfo->context, WindowAggState)
+    #endif
+          )))
+        elog(ERROR,
+             "destructive pass by reference outside agg");
+
+    /* get the provided element, being careful in case it's NULL */
+    if (PG_ARGISNULL(1))
+        PG_RETURN_DATUM(PointerGetDatum(transblob));
+
+    if (!QS_TRANSVAL_INITIALIZED(transblob))
+        transblob = qsketch_init_transval();
+    else
+        check_qstransval(transblob);
+
+    transblob = qsketch_insert(transblob, PG_GETARG_FLOAT8(1), 0);
+    QS_TRANSVAL(transblob)->n++;
+    PG_RETURN_DATUM(PointerGetDatum(transblob));
+}
+
+/*! allocate an empty sketch with a single level */
+bytea *qsketch_init_transval()
+{
+    bytea *transblob = (bytea *)palloc0(QS_TRANSVAL_SZ(1));
+
+    SET_VARSIZE(transblob, QS_TRANSVAL_SZ(1));
+    QS_TRANSVAL(transblob)->nlevels = 1;
+    QS_TRANSVAL(transblob)->seed = 0x9E3779B9;
+    return(transblob);
+}
+
+/*! sanity check of a transval that is expected to be initialized */
+void check_qstransval(bytea *transblob)
+{
+    qstransval *transval = QS_TRANSVAL(transblob);
+
+    if (!QS_TRANSVAL_INITIALIZED(transblob)
+        || transval->nlevels < 1 || transval->nlevels > QS_MAXLEVELS
+        || VARSIZE(transblob) != QS_TRANSVAL_SZ(transval->nlevels))
+        elog(ERROR, "invalid transition state for qsketch");
+}
+
+/*! copy a sketch into a new one with one more (empty) level */
+static bytea *qsketch_add_level(bytea *transblob)
+{
+    uint32 nlevels = QS_TRANSVAL(transblob)->nlevels + 1;
+    bytea *newblob;
+
+    if (nlevels > QS_MAXLEVELS)
+        elog(ERROR, "too many values for a qsketch");
+    newblob = (bytea *)palloc0(QS_TRANSVAL_SZ(nlevels));
+    memcpy(newblob, transblob, VARSIZE(transblob));
+    SET_VARSIZE(newblob, QS_TRANSVAL_SZ(nlevels));
+    QS_TRANSVAL(newblob)->nlevels = nlevels;
+    return(newblob);
+}
+
+/*! next compaction offset (0 or 1), from a xorshift generator */
+static uint32 qsketch_random_bit(qstransval *transval)
+{
+    uint32 x = transval->seed;
+
+    x ^= x << 13;
+    x ^= x >> 17;
+    x ^= x << 5;
+    transval->seed = x;
+    return(x >> 31);
+}
+
+/*!
+ * insert a value at a given level, and compact the full levels.  The levels
+ * are only ever compacted upwards, so the values promoted from a level can
+ * stay in the slots of that level while they are inserted one level up.
+ * \param transblob a qsketch transval packed in a bytea
+ * \param val the value to insert
+ * \param level the level of the value (it stands for 2^level input values)
+ * \returns the transval, which is reallocated when a level is added
+ */
+bytea *qsketch_insert(bytea *transblob, float8 val, uint32 level)
+{
+    qstransval *transval;
+    float8 *    values;
+    uint32      i, offset;
+
+    while (level >= QS_TRANSVAL(transblob)->nlevels)
+        transblob = qsketch_add_level(transblob);
+    transval = QS_TRANSVAL(transblob);
+    values = QS_LEVEL(transval, level);
+    values[transval->sizes[level]++] = val;
+    if (transval->sizes[level] < QS_K)
+        return(transblob);
+
+    /* the level is full: keep every other value, with twice the weight */
+    qsort(values, QS_K, sizeof(float8), float8_cmp);
+    offset = qsketch_random_bit(transval);
+    for (i = 0; i < QS_K / 2; i++)
+        values[i] = values[2*i + offset];
+    transval->sizes[level] = 0;
+    for (i = 0; i < QS_K / 2; i++) {
+        /* the blob can move while we insert, so look the level up each time */
+        val = QS_LEVEL(QS_TRANSVAL(transblob), level)[i];
+        transblob = qsketch_insert(transblob, val, level + 1);
+    }
+    return(transblob);
+}
+
+PG_FUNCTION_INFO_V1(__qsketch_merge);
+
+/*!
+ * Greenplum "prefunc" to combine sketches from multiple machines.
+ */
+Datum __qsketch_merge(PG_FUNCTION_ARGS)
+{
+    bytea *transblob1 = PG_GETARG_BYTEA_P(0);
+    bytea *transblob2 = PG_GETARG_BYTEA_P(1);
+
+    PG_RETURN_DATUM(PointerGetDatum(qsketch_merge_c(transblob1, transblob2)));
+}
+
+/*!
+ * implementation of the merge of two quantile sketches: the values of the
+ * second sketch are inserted at their own level into a copy of the first one.
+ * \param transblob1 a qsketch transval stored inside a bytea
+ * \param transblob2 another qsketch transval in a bytea
+ */
+bytea *qsketch_merge_c(bytea *transblob1, bytea *transblob2)
+{
+    qstransval *transval2;
+    bytea *     newblob;
+    uint32      level, i;
+
+    /* handle uninitialized args */
+    if (!QS_TRANSVAL_INITIALIZED(transblob2))
+        return(transblob1);
+    check_qstransval(transblob2);
+    if (!QS_TRANSVAL_INITIALIZED(transblob1))
+        return(transblob2);
+    check_qstransval(transblob1);
+
+    newblob = (bytea *)palloc(VARSIZE(transblob1));
+    memcpy(newblob, transblob1, VARSIZE(transblob1));
+    transval2 = QS_TRANSVAL(transblob2);
+    for (level = 0; level < transval2->nlevels; level++)
+        for (i = 0; i < transval2->sizes[level]; i++)
+            newblob = qsketch_insert(newblob,
+                                     QS_LEVEL(transval2, level)[i], level);
+    QS_TRANSVAL(newblob)->n += transval2->n;
+    return(newblob);
+}
+
+PG_FUNCTION_INFO_V1(qsketch_quantiles);
+
+/*!
+ * estimate quantiles from a sketch.  Quantile q is the value at position
+ * q * (n - 1) in sorted order, interpolated like <c>percentile_cont</c>.
+ * Returns NULL for a sketch of no values.
+ */
+Datum qsketch_quantiles(PG_FUNCTION_ARGS)
+{
+    bytea *     transblob = PG_GETARG_BYTEA_P(0);
+    ArrayType * quantiles = PG_GETARG_ARRAYTYPE_P(1);
+    qstransval *transval;
+    qsitem *    items;
+    float8 *    q, *result, *mid;
+    int64       cum;
+    uint32      nitems, level, i, j;
+    int         nq;
+
+    if (!QS_TRANSVAL_INITIALIZED(transblob))
+        PG_RETURN_NULL();
+    check_qstransval(transblob);
+    transval = QS_TRANSVAL(transblob);
+
+    if (ARR_ELEMTYPE(quantiles) != FLOAT8OID || ARR_NDIM(quantiles) > 1
+        || ARR_HASNULL(quantiles))
+        elog(ERROR, "quantiles should be a one-dimensional FLOAT8 array without NULLs");
+    nq = ArrayGetNItems(ARR_NDIM(quantiles), ARR_DIMS(quantiles));
+    q = (float8 *)ARR_DATA_PTR(quantiles);
+    for (j = 0; j < (uint32)nq; j++)
+        if (!(q[j] >= 0 && q[j] <= 1))
+            elog(ERROR, "quantiles should be in the range [0, 1]");
+
+    /* gather the values with their weights, in sorted order */
+    for (level = 0, nitems = 0; level < transval->nlevels; level++)
+        nitems += transval->sizes[level];
+    items = (qsitem *)palloc(nitems*sizeof(qsitem));
+    for (level = 0, nitems = 0; level < transval->nlevels; level++)
+        for (i = 0; i < transval->sizes[level]; i++, nitems++) {
+            items[nitems].value = QS_LEVEL(transval, level)[i];
+            items[nitems].weight = INT64CONST(1) << level;
+        }
+    qsort(items, nitems, sizeof(qsitem), qsitem_cmp);
+
+    /* the middle rank covered by each value */
+    mid = (float8 *)palloc(nitems*sizeof(float8));
+    for (i = 0, cum = 0; i < nitems; i++) {
+        mid[i] = cum + (items[i].weight - 1) / 2.0;
+        cum += items[i].weight;
+    }
+
+    result = (float8 *)palloc(nq*sizeof(float8));
+    for (j = 0; j < (uint32)nq; j++) {
+        float8 pos = q[j] * (transval->n - 1);
+
+        for (i = 0; i < nitems && mid[i] < pos; i++)
+            ;
+        if (i == 0)
+            result[j] = items[0].value;
+        else if (i == nitems)
+            result[j] = items[nitems - 1].value;
+        else
+            result[j] = items[i - 1].value
+                        + (pos - mid[i - 1]) / (mid[i] - mid[i - 1])
+                        * (items[i].value - items[i - 1].value);
+    }
+
+    PG_RETURN_ARRAYTYPE_P(construct_array((Datum *)result, nq, FLOAT8OID,
+                                          sizeof(float8), true, 'd'));
+}
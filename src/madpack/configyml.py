@@ -162,4 +162,23 @@ def topsort_modules(conf):
             print  "    " + m + " (required by " + str(list(inverted[m])) + ")"
         exit(2)
     conf['modules'] = sorted(conf['modules'], key=lambda m:module_dict[m['name']])
+    # Keep the levels: modules on the same level do not depend on each other
+    conf['levels'] = module_dict
     return conf
+
+##
+# Group the top-sorted modules by dependency level
+# @param conf a madpack configuration returned by get_modules()
+# @return list of lists of module infos, one list per level in install order
+##
+def get_module_levels(conf):
+
+    levels = []
+    curlevel = None
+    for m in conf['modules']:
+        level = conf['levels'][m['name']]
+        if level != curlevel:
+            levels.append([])
+            curlevel = level
+        levels[-1].append(m)
+    return levels
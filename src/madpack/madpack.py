@@ -13,6 +13,14 @@ import datetime
 from time import strftime
 import tempfile
 import shutil
+import threading
+import Queue
+import atexit
+import hashlib
+import stat
+import time
+import json
+from xml.sax.saxutils import quoteattr
 
 from upgrade_util import ChangeHandler
 from upgrade_util import ViewDependency
@@ -40,6 +48,16 @@ sys.path.append(maddir + "/madpack")
 # Import MADlib python modules
 import argparse
 import configyml
+import yaml
+
+# PyGreSQL is optional: without it we fall back to the psql command-line utility
+try:
+    from pygresql import pg
+except ImportError:
+    try:
+        import pg
+    except ImportError:
+        pg = None
 
 # Some read-only variables
 this = os.path.basename(sys.argv[0])    # name of this script
@@ -61,6 +79,14 @@ dbconn = None       # DB Connection object
 dbver = None        # DB version
 con_args = {}       # DB connection arguments
 verbose = None      # Verbose flag
+jobs = 1            # Number of parallel workers
+sc_lock = threading.Lock()  # Serializes ScriptCleaner use across workers
+dbsessions = {}     # Live DB sessions keyed by connection arguments
+dbsessions_lock = threading.Lock()
+m4cache_dir = None  # Cache dir for m4 output (None: no caching)
+m4cache_stats = {'hit': 0, 'miss': 0}
+m4cache_lock = threading.Lock()
+m4cache_max_age = 30 * 24 * 3600  # Cache entries unused for longer are pruned
 
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Create a temp dir
@@ -74,6 +100,33 @@ def __make_dir(dir):
             print "ERROR: can not create directory: %s. Check permissions." % dir
             exit(1)
 
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Create or open the m4 cache dir and prune the entries not used recently
+# The cached files are run as install scripts, so the dir must be private:
+# it is created with mode 0700 and refused if anybody else can write to it.
+# @param dir m4 cache directory path
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __open_m4cache(dir):
+    if not os.path.isdir(dir):
+        try:
+            os.makedirs(dir, 0700)
+        except:
+            __error("cannot create m4 cache directory: %s." % dir, True)
+    st = os.stat(dir)
+    if st.st_uid != os.getuid() or st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        __error("m4 cache directory %s must be owned by the current user and "
+                "not writable by group or others." % dir, True)
+
+    now = time.time()
+    for name in os.listdir(dir):
+        path = os.path.join(dir, name)
+        try:
+            if now - os.path.getmtime(path) > m4cache_max_age:
+                os.remove(path)
+        except OSError:
+            # Removed by a concurrent run
+            pass
+
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Error message wrapper
 # @param msg error message
@@ -99,11 +152,61 @@ def __info(msg, verbose):
     if verbose:
         print this + ' : INFO : ' + msg
 
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Get the live database session for the given connection arguments
+# Sessions are opened on first use and reused by all later queries, so
+# only one connection handshake is made per database.
+# @param con_args database connection arguments
+# @return (connection, lock) tuple or None if no driver is available or
+#         the connection cannot be established
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __get_db_session(con_args):
+    if pg is None:
+        return None
+
+    key = (con_args['host'], con_args['database'], con_args['user'])
+    dbsessions_lock.acquire()
+    try:
+        if key not in dbsessions:
+            try:
+                db = pg.DB(dbname = con_args['database'],
+                           host = con_args['host'].split(':')[0],
+                           port = int(con_args['host'].split(':')[1]),
+                           user = con_args['user'],
+                           passwd = con_args['password'])
+                # Same session settings as used for the psql utility
+                db.query("SET client_min_messages = error")
+                db.query("SET search_path = public")
+                dbsessions[key] = (db, threading.Lock())
+            except Exception, e:
+                __info("Cannot open database session (%s), using psql instead"
+                       % str(e).strip(), verbose)
+                dbsessions[key] = None
+        return dbsessions[key]
+    finally:
+        dbsessions_lock.release()
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Close all live database sessions
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __close_db_sessions():
+    for session in dbsessions.values():
+        if session is not None:
+            try:
+                session[0].close()
+            except:
+                pass
+    dbsessions.clear()
+
+atexit.register(__close_db_sessions)
+
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Runs a SQL query on the target platform DB
-# using the default command-line utility.
-# Very limited:
+# through a persistent database session if the PyGreSQL driver is available,
+# and using the default command-line utility otherwise.
+# The command-line utility is very limited:
 #   - no text output with "new line" characters allowed
+#   - all values are returned as text (NULL as an empty string)
 # @param sql query text to execute
 # @param show_error displays the SQL error msg
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
@@ -112,11 +215,41 @@ def __run_sql_query(sql, show_error):
     global con_args
     return ____run_sql_query(sql, show_error, portid, con_args)
 
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Runs a SQL query in a live database session
+# @param session (connection, lock) tuple returned by __get_db_session
+# @param sql query text to execute
+# @param show_error displays the SQL error msg
+# @return list of rows as dictionaries of typed col_name:col_value pairs
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __run_sql_query_session(session, sql, show_error):
+    (db, lock) = session
+    lock.acquire()
+    try:
+        try:
+            res = db.query(sql)
+        except Exception, e:
+            if show_error:
+                __error("SQL command failed: \nSQL: %s \n%s" % (sql, e), False)
+            raise Exception
+    finally:
+        lock.release()
+
+    # Utility statements return None or the number of affected rows
+    if res is None or isinstance(res, basestring):
+        return []
+    return res.dictresult()
+
 def ____run_sql_query(sql, show_error, portid = portid, con_args = con_args):
 
     # Postgres & Greenplum
     if portid == 'greenplum' or portid == 'postgres':
 
+        # Use the live session if we have one
+        session = __get_db_session(con_args)
+        if session is not None:
+            return __run_sql_query_session(session, sql, show_error)
+
         # Define sqlcmd
         sqlcmd = 'psql'
         delimiter = '|'
@@ -165,6 +298,65 @@ def ____run_sql_query(sql, show_error, portid = portid, con_args = con_args):
 
     return results
 
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Run m4 on a SQL file, reusing the cached output if possible
+# The m4 output only depends on the source file, the files it can include,
+# the definitions passed to m4 and the MADlib/DB versions, so all of these
+# make up the cache key.
+# @param m4args m4 command line
+# @param sqlfile name of the file to parse
+# @param maddir_madpack m4 include directory
+# @param f open file object to write the output to
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __run_m4(m4args, sqlfile, maddir_madpack, f):
+
+    if m4cache_dir is None:
+        subprocess.call(m4args, stdout=f)
+        return
+
+    key = hashlib.sha1()
+    key.update('\0'.join(m4args[:-1] + [rev, dbver]))
+    for name in [sqlfile] + sorted(glob.glob(maddir_madpack + '/*.m4')):
+        key.update('\0' + name + '\0')
+        key.update(open(name, 'rb').read())
+    cachefile = os.path.join(m4cache_dir, key.hexdigest() + '.sql')
+
+    m4cache_lock.acquire()
+    hit = os.path.isfile(cachefile)
+    m4cache_stats['hit' if hit else 'miss'] += 1
+    m4cache_lock.release()
+
+    if not hit:
+        # Write to a private file first, so that concurrent runs never
+        # see a partial cache entry
+        (fd, newfile) = tempfile.mkstemp('.tmp', 'm4.', m4cache_dir)
+        out = os.fdopen(fd, 'w')
+        try:
+            retval = subprocess.call(m4args, stdout=out)
+        finally:
+            out.close()
+        if retval != 0:
+            # Do not cache failures, pass on whatever m4 produced
+            f.write(open(newfile).read())
+            os.remove(newfile)
+            return
+        os.rename(newfile, cachefile)
+    else:
+        __info("> ... using cached m4 output " + cachefile, verbose)
+        # Keep the entry from being pruned
+        os.utime(cachefile, None)
+
+    f.write(open(cachefile).read())
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Print the m4 cache hit/miss counts (verbose)
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __print_m4cache_stats():
+    if m4cache_dir is not None:
+        __info("m4 cache: %d hits, %d misses (%s)"
+               % (m4cache_stats['hit'], m4cache_stats['miss'], m4cache_dir),
+               verbose)
+
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Run SQL file
 # @param schema name of the target schema
@@ -213,7 +405,7 @@ def __run_sql_file(schema, maddir_mod_py, module, sqlfile,
 
         __info("> ... parsing: " + " ".join(m4args), verbose )
 
-        subprocess.call(m4args, stdout=f)
+        __run_m4(m4args, sqlfile, maddir_madpack, f)
         f.close()
     except:
         __error("Failed executing m4 on %s" % sqlfile, False)
@@ -230,7 +422,11 @@ def __run_sql_file(schema, maddir_mod_py, module, sqlfile,
         if (sub_module not in sc.get_change_handler().get_newmodule()) and \
             not (sub_module == 'svec' and 'svec' in sc.get_change_handler().get_udt()):
             sql = open(tmpfile).read()
-            sql = sc.cleanup(sql)
+            sc_lock.acquire()
+            try:
+                sql = sc.cleanup(sql)
+            finally:
+                sc_lock.release()
             open(tmpfile, 'w').write(sql)
 
     # Run the SQL using DB command-line utility
@@ -505,22 +701,21 @@ def __db_install(schema, dbrev):
     __info("MADlib %s installed successfully in %s schema." % (rev, schema.upper()), True)
 
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-# Upgrade MADlib
+# Detect the user tables and views depending on MADlib objects in the target
+# database, and abort if any of them depends on an object changed by the
+# upgrade.
 # @param schema MADlib schema name
-# @param dbrev DB-level MADlib version
+# @param ch ChangeHandler of the upgrade
+# @param vd ViewDependency loaded from an upgrade plan, detected if None
+# @return (TableDependency, ViewDependency) tuple
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
-def __db_upgrade(schema, dbrev):
-    __info("Upgrading MADlib into %s schema..." % schema.upper(), True)
-    __info("\tDetecting dependencies...", True)
-
-    __info("\tLoading change list...", True)
-    ch = ChangeHandler(schema, portid, con_args, maddir, dbrev)
-
+def __db_check_upgrade_dependencies(schema, ch, vd=None):
     __info("\tDetecting table dependencies...", True)
     td = TableDependency(schema, portid, con_args)
 
-    __info("\tDetecting view dependencies...", True)
-    vd = ViewDependency(schema, portid, con_args)
+    if vd is None:
+        __info("\tDetecting view dependencies...", True)
+        vd = ViewDependency(schema, portid, con_args)
 
     abort = False
     if td.has_dependency():
@@ -562,13 +757,117 @@ def __db_upgrade(schema, dbrev):
 
     if abort:
         __error('------- Upgrade aborted. -------', True)
-    else:
-        __info("No explicit dependency problem found, continuing to upgrade ...", True)
-        if vd.has_dependency():
-            vd.save_and_drop()
+
+    return (td, vd)
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Compute the upgrade plan: the changed objects to drop, the dependent views
+# to save and restore, and the existing objects which the upgrade scripts must
+# not create again. Aborts if user objects depend on changed MADlib objects.
+# The database is not modified.
+# @param schema MADlib schema name
+# @param dbrev DB-level MADlib version
+# @return (ChangeHandler, ViewDependency, ScriptCleaner) tuple
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_plan_upgrade(schema, dbrev):
+    __info("\tDetecting dependencies...", True)
+
+    __info("\tLoading change list...", True)
+    ch = ChangeHandler(schema, portid, con_args, maddir, dbrev)
+
+    (td, vd) = __db_check_upgrade_dependencies(schema, ch)
 
     __info("\tReading existing UDAs/UDTs...", False)
     sc = ScriptCleaner(schema, portid, con_args, ch)
+    return (ch, vd, sc)
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Write the upgrade plan to a file
+# @param planfile name of the plan file
+# @param schema MADlib schema name
+# @param dbrev DB-level MADlib version
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __write_upgrade_plan(planfile, schema, dbrev):
+    (ch, vd, sc) = __db_plan_upgrade(schema, dbrev)
+    plan = {'schema': schema,
+            'port': portid,
+            'from_version': dbrev,
+            'to_version': rev,
+            'created': strftime('%Y-%m-%d %H:%M:%S'),
+            'catalog': sc.get_catalog_fingerprint(),
+            'changes': ch.get_plan(),
+            'views': vd.get_plan(),
+            'script': sc.get_plan()}
+    try:
+        f = open(planfile, 'w')
+        yaml.safe_dump(plan, f, default_flow_style=False)
+        f.close()
+    except IOError:
+        __error("Cannot write upgrade plan: %s" % planfile, True)
+    __info("Upgrade plan written to %s" % planfile, True)
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Read the upgrade plan from a file
+# @param planfile name of the plan file
+# @param schema MADlib schema name
+# @param dbrev DB-level MADlib version
+# @return (ChangeHandler, ViewDependency, ScriptCleaner) tuple
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __read_upgrade_plan(planfile, schema, dbrev):
+    __info("\tLoading upgrade plan %s..." % planfile, True)
+    try:
+        plan = yaml.safe_load(open(planfile))
+    except:
+        __error("Missing or malformed upgrade plan: %s" % planfile, False)
+        raise Exception
+
+    # The plan is only valid for the same upgrade path
+    for (key, value) in (('schema', schema), ('port', portid),
+                         ('from_version', dbrev), ('to_version', rev)):
+        if str(plan.get(key)) != str(value):
+            __error("Upgrade plan %s was computed for %s %s, not %s"
+                    % (planfile, key, plan.get(key), value), False)
+            raise Exception
+
+    ch = ChangeHandler(schema, portid, con_args, maddir, dbrev, plan['changes'])
+    sc = ScriptCleaner(schema, portid, con_args, ch, plan['script'])
+
+    # The plan is only valid for the MADlib objects it was computed for
+    if plan.get('catalog') != sc.get_catalog_fingerprint():
+        __error("Upgrade plan %s does not match the MADlib objects in the "
+                "database; run plan-upgrade again" % planfile, False)
+        raise Exception
+
+    # User tables and views may have changed since the plan was computed.
+    # Only the cheap checks are repeated: the tables are detected again, the
+    # view-on-view graph is taken from the plan once the views directly
+    # depending on MADlib still match it.
+    vd = ViewDependency(schema, portid, con_args, plan['views'])
+    if not vd.same_direct_dependency():
+        __error("Upgrade plan %s does not match the views depending on "
+                "MADlib in the database; run plan-upgrade again"
+                % planfile, False)
+        raise Exception
+    (td, vd) = __db_check_upgrade_dependencies(schema, ch, vd)
+    return (ch, vd, sc)
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Upgrade MADlib
+# @param schema MADlib schema name
+# @param dbrev DB-level MADlib version
+# @param planfile optional upgrade plan computed by plan-upgrade
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_upgrade(schema, dbrev, planfile=None):
+    __info("Upgrading MADlib into %s schema..." % schema.upper(), True)
+
+    if planfile:
+        (ch, vd, sc) = __read_upgrade_plan(planfile, schema, dbrev)
+    else:
+        (ch, vd, sc) = __db_plan_upgrade(schema, dbrev)
+
+    __info("No explicit dependency problem found, continuing to upgrade ...", True)
+    if vd.has_dependency():
+        vd.save_and_drop()
 
     ch.drop_changed_uda()
     ch.drop_changed_udt()
@@ -653,52 +952,107 @@ def __db_create_objects(schema, old_schema, upgrade=False, sc=None):
         __info("> Creating objects for modules:", True)
 
     # Loop through all modules/modules
-    for moduleinfo in portspecs['modules']:
+    if jobs > 1:
+        __info("> Using %d parallel workers" % jobs, True)
+        for level in configyml.get_module_levels(portspecs):
+            # Modules on the same level do not depend on each other
+            tasks = [(__db_create_module, (schema, moduleinfo, upgrade, sc))
+                        for moduleinfo in level]
+            failed = __run_parallel(tasks, jobs)
+            if failed:
+                raise Exception
+    else:
+        for moduleinfo in portspecs['modules']:
+            __db_create_module(schema, moduleinfo, upgrade, sc)
 
-        # Get the module name
-        module = moduleinfo['name']
-        __info("> - %s" % module, True)
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Create MADlib DB objects for a single module
+# @param schema name of the target schema
+# @param moduleinfo module entry from Modules.yml
+# @param upgrade are we upgrading as part of this sql run
+# @param sc ScriptCleaner object
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __db_create_module(schema, moduleinfo, upgrade=False, sc=None):
 
-        # Find the Python module dir (platform specific or generic)
-        if os.path.isdir(maddir + "/ports/" + portid + "/" + dbver + "/modules/" + module):
-            maddir_mod_py  = maddir + "/ports/" + portid + "/" + dbver + "/modules"
-        else:
-            maddir_mod_py  = maddir + "/modules"
+    # Get the module name
+    module = moduleinfo['name']
+    __info("> - %s" % module, True)
 
-        # Find the SQL module dir (platform specific or generic)
-        if os.path.isdir(maddir + "/ports/" + portid + "/modules/" + module):
-            maddir_mod_sql  = maddir + "/ports/" + portid + "/modules"
-        elif os.path.isdir(maddir + "/modules/" + module):
-            maddir_mod_sql  = maddir + "/modules"
-        else:
-            # This was a platform-specific module, for which no default exists.
-            # We can just skip this module.
-            continue
-
-        # Make a temp dir for log files
-        cur_tmpdir = tmpdir + "/" + module
-        __make_dir(cur_tmpdir)
-
-        # Loop through all SQL files for this module
-        mask = maddir_mod_sql + '/' + module + '/*.sql_in'
-        sql_files = glob.glob(mask)
-
-        if not sql_files:
-            __error("No files found in: %s" % mask, True)
-
-        # Execute all SQL files for the module
-        for sqlfile in sql_files:
-            # Set file names
-            tmpfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.tmp'
-            logfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.log'
-            retval = __run_sql_file(schema, maddir_mod_py, module, sqlfile,
-                                        tmpfile, logfile, None, upgrade,
-                                        sc)
-            # Check the exit status
-            if retval != 0:
-                __error("Failed executing %s" % tmpfile, False)
-                __error("Check the log at %s" % logfile, False)
-                raise Exception
+    # Find the Python module dir (platform specific or generic)
+    if os.path.isdir(maddir + "/ports/" + portid + "/" + dbver + "/modules/" + module):
+        maddir_mod_py  = maddir + "/ports/" + portid + "/" + dbver + "/modules"
+    else:
+        maddir_mod_py  = maddir + "/modules"
+
+    # Find the SQL module dir (platform specific or generic)
+    if os.path.isdir(maddir + "/ports/" + portid + "/modules/" + module):
+        maddir_mod_sql  = maddir + "/ports/" + portid + "/modules"
+    elif os.path.isdir(maddir + "/modules/" + module):
+        maddir_mod_sql  = maddir + "/modules"
+    else:
+        # This was a platform-specific module, for which no default exists.
+        # We can just skip this module.
+        return
+
+    # Make a temp dir for log files
+    cur_tmpdir = tmpdir + "/" + module
+    __make_dir(cur_tmpdir)
+
+    # Loop through all SQL files for this module
+    mask = maddir_mod_sql + '/' + module + '/*.sql_in'
+    sql_files = glob.glob(mask)
+
+    if not sql_files:
+        __error("No files found in: %s" % mask, True)
+
+    # Execute all SQL files for the module
+    for sqlfile in sql_files:
+        # Set file names
+        tmpfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.tmp'
+        logfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.log'
+        retval = __run_sql_file(schema, maddir_mod_py, module, sqlfile,
+                                    tmpfile, logfile, None, upgrade,
+                                    sc)
+        # Check the exit status
+        if retval != 0:
+            __error("Failed executing %s" % tmpfile, False)
+            __error("Check the log at %s" % logfile, False)
+            raise Exception
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Run independent tasks on a pool of worker threads
+# The work is done by the psql/m4 child processes, so threads are enough.
+# All tasks are run to completion even if some of them fail.
+# @param tasks list of (function, args) tuples
+# @param njobs maximum number of tasks running at the same time
+# @return list of the tasks that failed
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __run_parallel(tasks, njobs):
+
+    queue = Queue.Queue()
+    for task in tasks:
+        queue.put(task)
+    failed = []
+
+    def worker():
+        while True:
+            try:
+                task = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                task[0](*task[1])
+            except (Exception, SystemExit):
+                # list.append is atomic
+                failed.append(task)
+
+    workers = [threading.Thread(target=worker)
+                for i in range(min(njobs, len(tasks)))]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return failed
 
 ## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Rollback installation
@@ -727,6 +1081,163 @@ def __db_rollback(drop_schema, keep_schema):
     raise Exception
 
 
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Run the install-check test files of a module
+# @param schema MADlib schema name
+# @param module name of the module
+# @param test_user database user running the tests
+# @param results list to append one result dictionary per test file to
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __run_install_check_module(schema, module, test_user, results):
+    global keeplogs
+
+    __info("> - %s" % module, verbose)
+
+    # Make a temp dir for this module (if doesn't exist)
+    cur_tmpdir = tmpdir + '/' + module + '/test'
+    __make_dir(cur_tmpdir)
+
+    # Find the Python module dir (platform specific or generic)
+    if os.path.isdir(maddir + "/ports/" + portid + "/" + dbver + "/modules/" + module):
+        maddir_mod_py  = maddir + "/ports/" + portid + "/" + dbver + "/modules"
+    else:
+        maddir_mod_py  = maddir + "/modules"
+
+    # Find the SQL module dir (platform specific or generic)
+    if os.path.isdir(maddir + "/ports/" + portid + "/modules/" + module):
+        maddir_mod_sql  = maddir + "/ports/" + portid + "/modules"
+    else:
+        maddir_mod_sql  = maddir + "/modules"
+
+    # Prepare test schema
+    test_schema = "madlib_installcheck_%s" % (module)
+    __run_sql_query("DROP SCHEMA IF EXISTS %s CASCADE; CREATE SCHEMA %s;"
+                    % (test_schema, test_schema), True)
+    __run_sql_query("GRANT ALL ON SCHEMA %s TO %s;"
+                    % (test_schema, test_user), True)
+
+    # Switch to test user and prepare the search_path
+    pre_sql = '-- Switch to test user:\n' \
+              'SET ROLE %s;\n' \
+              '-- Set SEARCH_PATH for install-check:\n' \
+              'SET search_path=%s,%s;\n' \
+              % (test_user, test_schema, schema)
+
+    # Loop through all test SQL files for this module
+    sql_files = maddir_mod_sql + '/' + module + '/test/*.sql_in'
+    for order, sqlfile in enumerate(sorted(glob.glob(sql_files),reverse=True)):
+
+        result = 'PASS'
+
+        # Set file names
+        tmpfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.tmp'
+        logfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.log'
+
+        # If there is no problem with the SQL file
+        milliseconds = 0
+
+        # Run the SQL
+        run_start = datetime.datetime.now()
+        retval = __run_sql_file(schema, maddir_mod_py, module,
+                                sqlfile, tmpfile, logfile, pre_sql)
+        # Runtime evaluation
+        run_end = datetime.datetime.now()
+        milliseconds = round((run_end - run_start).seconds * 1000
+                            + (run_end - run_start).microseconds / 1000)
+
+        # Check the exit status
+        if retval != 0:
+            __error("Failed executing %s" % tmpfile, False)
+            __error("Check the log at %s" % logfile, False)
+            result = 'FAIL'
+            keeplogs = True
+        # Since every single statement in the test file gets logged,
+        # an empty log file indicates an empty or a failed test
+        elif os.path.isfile(logfile) and os.path.getsize(logfile) > 0:
+            result = 'PASS'
+        # Otherwise
+        else:
+            result = 'ERROR'
+
+        # Spit the line (in one write, workers may run concurrently)
+        sys.stdout.write("TEST CASE RESULT|Module: " + module + \
+            "|" + os.path.basename(sqlfile) + "|" + result + \
+            "|Time: %d milliseconds\n" % (milliseconds))
+        sys.stdout.flush()
+
+        results.append({'module': module,
+                        'file': os.path.basename(sqlfile),
+                        'order': order,
+                        'result': result,
+                        'milliseconds': int(milliseconds),
+                        'log': logfile})
+
+    # Cleanup test schema for the module
+    __run_sql_query( "DROP SCHEMA IF EXISTS %s CASCADE;" % (test_schema), True)
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Write install-check results as JSON
+# @param filename name of the report file
+# @param results list of result dictionaries
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __write_json_report(filename, results):
+    report = {'version': rev,
+              'port': portid,
+              'dbver': dbver,
+              'tests': [dict((k, r[k]) for k in
+                            ('module', 'file', 'result', 'milliseconds'))
+                        for r in results]}
+    try:
+        f = open(filename, 'w')
+        json.dump(report, f, indent=2)
+        f.close()
+    except IOError:
+        __error("Cannot write report file: %s" % filename, False)
+        return
+    __info("JSON report written to %s" % filename, True)
+
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# Write install-check results as JUnit XML
+# One test suite per module, one test case per test file.
+# @param filename name of the report file
+# @param results list of result dictionaries
+## # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+def __write_junit_report(filename, results):
+    suites = []
+    for r in results:
+        if not suites or suites[-1][0] != r['module']:
+            suites.append((r['module'], []))
+        suites[-1][1].append(r)
+
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<testsuites>']
+    for (module, cases) in suites:
+        lines.append('  <testsuite name=%s tests="%d" failures="%d" errors="%d" time="%.3f">'
+            % (quoteattr('madlib.' + module), len(cases),
+               len([c for c in cases if c['result'] == 'FAIL']),
+               len([c for c in cases if c['result'] == 'ERROR']),
+               sum([c['milliseconds'] for c in cases]) / 1000.0))
+        for c in cases:
+            lines.append('    <testcase classname=%s name=%s time="%.3f">'
+                % (quoteattr('madlib.' + module), quoteattr(c['file']),
+                   c['milliseconds'] / 1000.0))
+            if c['result'] == 'FAIL':
+                lines.append('      <failure message=%s/>'
+                    % quoteattr("Failed, check the log at " + c['log']))
+            elif c['result'] == 'ERROR':
+                lines.append('      <error message="Empty log, the test is empty or failed"/>')
+            lines.append('    </testcase>')
+        lines.append('  </testsuite>')
+    lines.append('</testsuites>')
+    try:
+        f = open(filename, 'w')
+        f.write('\n'.join(lines) + '\n')
+        f.close()
+    except IOError:
+        __error("Cannot write report file: %s" % filename, False)
+        return
+    __info("JUnit report written to %s" % filename, True)
+
+
 def unescape(string):
     """
     Unescape separation characters in connection strings, i.e., remove first
@@ -780,10 +1291,11 @@ def main(argv):
 
     parser.add_argument(
         'command', metavar='COMMAND', nargs=1,
-        choices=['install','update', 'upgrade', 'uninstall','reinstall','version','install-check'],
+        choices=['install','update', 'upgrade', 'plan-upgrade', 'uninstall','reinstall','version','install-check'],
         help = "One of the following options:\n"
             + "  install        : run sql scripts to load into DB\n"
             + "  upgrade        : run sql scripts to upgrade\n"
+            + "  plan-upgrade   : compute the upgrade plan and write it to --plan FILE\n"
             + "  uninstall      : run sql scripts to uninstall from DB\n"
             + "  reinstall      : performs uninstall and install\n"
             + "  version        : compare and print MADlib version (binaries vs database objects)\n"
@@ -819,9 +1331,33 @@ def main(argv):
     parser.add_argument('-d', '--tmpdir', dest='tmpdir', default = '/tmp/',
                          help="Temporary directory location for installation log files.")
 
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                         metavar='N',
+                         help="Number of modules to install or test in parallel (default: 1).\n"
+                            + "Only modules that do not depend on each other are installed\n"
+                            + "at the same time.")
+
+    parser.add_argument('--m4cache', dest='m4cache', default=None,
+                         metavar='DIR',
+                         help="Directory for caching preprocessed SQL files across runs\n"
+                            + "(default: no caching). The directory must be private to the\n"
+                            + "current user, entries unused for 30 days are removed.")
+
+    parser.add_argument('--plan', dest='plan', default=None, metavar='FILE',
+                         help="Upgrade plan file written by plan-upgrade and read by upgrade.\n"
+                            + "Databases with the same MADlib installation can share one plan.")
+
     parser.add_argument('-t', '--testcase', dest='testcase', default="",
                          help="Module names to test, comma separated. Effective only for install-check.")
 
+    parser.add_argument('--json-report', dest='json_report', default=None,
+                         metavar='FILE',
+                         help="Write install-check results with per-file time as JSON to FILE.")
+
+    parser.add_argument('--junit-report', dest='junit_report', default=None,
+                         metavar='FILE',
+                         help="Write install-check results with per-file time as JUnit XML to FILE.")
+
     ##
     # Get the arguments
     ##
@@ -831,6 +1367,8 @@ def main(argv):
     __info("Arguments: " + str(args), verbose);
     global keeplogs
     keeplogs = args.keeplogs
+    global jobs
+    jobs = max(1, args.jobs)
 
     global tmpdir
     try:
@@ -839,6 +1377,11 @@ def main(argv):
         tmpdir = e.filename
         __error("cannot create temporary directory: '%s'." % tmpdir, True)
 
+    global m4cache_dir
+    if args.m4cache:
+        m4cache_dir = os.path.abspath(args.m4cache)
+        __open_m4cache(m4cache_dir)
+
 
     ##
     # Parse SCHEMA
@@ -1060,7 +1603,9 @@ def main(argv):
     ###
     # COMMAND: upgrade
     ###
-    if args.command[0] in ('upgrade', 'update'):
+    if args.command[0] in ('upgrade', 'update', 'plan-upgrade'):
+        if args.command[0] == 'plan-upgrade' and not args.plan:
+            __error("Missing --plan parameter.", True)
         __info("*** Upgrading MADlib ***", True)
         dbrev = __get_madlib_dbver(schema)
 
@@ -1081,10 +1626,18 @@ def main(argv):
                     incremental upgrade is supported.""", True)
             return
 
-        # 3) Run upgrade
+        # 3) Only compute the plan
+        if args.command[0] == 'plan-upgrade':
+            try:
+                __write_upgrade_plan(args.plan, schema, dbrev)
+            except Exception as e:
+                __error("MADlib upgrade planning failed.", True)
+            return
+
+        # 4) Run upgrade
         try:
             __plpy_check(py_min_ver)
-            __db_upgrade(schema, dbrev)
+            __db_upgrade(schema, dbrev, args.plan)
         except Exception as e:
             __error("MADlib upgrade failed.", True)
             #Uncomment the following lines when debugging
@@ -1124,90 +1677,28 @@ def main(argv):
             for test in args.testcase.split(',')]) if args.testcase != "" else set()
 
         # Loop through all modules
-        for moduleinfo in portspecs['modules']:
-
-            # Get module name
-            module = moduleinfo['name']
-
-            # Skip if doesn't meet specified modules
-            if len(caseset) > 0 and module not in caseset:
-                continue
-
-            __info("> - %s" % module, verbose)
-
-            # Make a temp dir for this module (if doesn't exist)
-            cur_tmpdir = tmpdir + '/' + module + '/test'
-            __make_dir(cur_tmpdir)
-
-            # Find the Python module dir (platform specific or generic)
-            if os.path.isdir(maddir + "/ports/" + portid + "/" + dbver + "/modules/" + module):
-                maddir_mod_py  = maddir + "/ports/" + portid + "/" + dbver + "/modules"
-            else:
-                maddir_mod_py  = maddir + "/modules"
+        modules = [moduleinfo['name'] for moduleinfo in portspecs['modules']
+                    if len(caseset) == 0 or moduleinfo['name'] in caseset]
+        results = []
+        if jobs > 1:
+            # Each module runs in its own schema, so modules are independent
+            __info("> Using %d parallel workers" % jobs, True)
+            tasks = [(__run_install_check_module,
+                        (schema, module, test_user, results))
+                        for module in modules]
+            for task in __run_parallel(tasks, jobs):
+                __error("Install-check of module %s failed to run" % task[1][1],
+                        False)
+        else:
+            for module in modules:
+                __run_install_check_module(schema, module, test_user, results)
 
-            # Find the SQL module dir (platform specific or generic)
-            if os.path.isdir(maddir + "/ports/" + portid + "/modules/" + module):
-                maddir_mod_sql  = maddir + "/ports/" + portid + "/modules"
-            else:
-                maddir_mod_sql  = maddir + "/modules"
-
-            # Prepare test schema
-            test_schema = "madlib_installcheck_%s" % (module)
-            __run_sql_query("DROP SCHEMA IF EXISTS %s CASCADE; CREATE SCHEMA %s;"
-                            % (test_schema, test_schema), True)
-            __run_sql_query("GRANT ALL ON SCHEMA %s TO %s;"
-                            % (test_schema, test_user), True)
-
-            # Switch to test user and prepare the search_path
-            pre_sql = '-- Switch to test user:\n' \
-                      'SET ROLE %s;\n' \
-                      '-- Set SEARCH_PATH for install-check:\n' \
-                      'SET search_path=%s,%s;\n' \
-                      % (test_user, test_schema, schema)
-
-            # Loop through all test SQL files for this module
-            sql_files = maddir_mod_sql + '/' + module + '/test/*.sql_in'
-            for sqlfile in sorted(glob.glob(sql_files),reverse=True):
-
-                result = 'PASS'
-
-                # Set file names
-                tmpfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.tmp'
-                logfile = cur_tmpdir + '/' + os.path.basename(sqlfile) + '.log'
-
-                # If there is no problem with the SQL file
-                milliseconds = 0
-
-                # Run the SQL
-                run_start = datetime.datetime.now()
-                retval = __run_sql_file(schema, maddir_mod_py, module,
-                                        sqlfile, tmpfile, logfile, pre_sql)
-                # Runtime evaluation
-                run_end = datetime.datetime.now()
-                milliseconds = round((run_end - run_start).seconds * 1000
-                                    + (run_end - run_start).microseconds / 1000)
-
-                # Check the exit status
-                if retval != 0:
-                    __error("Failed executing %s" % tmpfile, False)
-                    __error("Check the log at %s" % logfile, False)
-                    result = 'FAIL'
-                    keeplogs = True
-                # Since every single statement in the test file gets logged,
-                # an empty log file indicates an empty or a failed test
-                elif os.path.isfile(logfile) and os.path.getsize(logfile) > 0:
-                    result = 'PASS'
-                # Otherwise
-                else:
-                    result = 'ERROR'
-
-                # Spit the line
-                print "TEST CASE RESULT|Module: " + module + \
-                    "|" + os.path.basename(sqlfile) + "|" + result + \
-                    "|Time: %d milliseconds" % (milliseconds)
-
-            # Cleanup test schema for the module
-            __run_sql_query( "DROP SCHEMA IF EXISTS %s CASCADE;" % (test_schema), True)
+        # Write the machine-readable reports
+        results.sort(key=lambda r: (modules.index(r['module']), r['order']))
+        if args.json_report:
+            __write_json_report(args.json_report, results)
+        if args.junit_report:
+            __write_junit_report(args.junit_report, results)
 
         # Drop install-check user
         __run_sql_query( "DROP OWNED BY %s CASCADE;" % (test_user), True)
@@ -1220,6 +1711,7 @@ if __name__ == "__main__":
 
     # Run main
     main(sys.argv[1:])
+    __print_m4cache_stats()
 
     # Optional log files cleanup
     if not keeplogs:
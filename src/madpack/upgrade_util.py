@@ -47,6 +47,29 @@ class UpgradeBase:
             """.format(schema=self._schema))[0]['oid']
 
 
+    """
+    @brief Get a fingerprint of the objects in the MADlib schema, which
+    changes whenever a function, aggregate or type is created or dropped
+    @note Objects are identified by their signatures, not by their oids, so
+    that databases with the same MADlib installation have the same fingerprint
+    """
+    def get_catalog_fingerprint(self):
+        return self._run_sql("""
+            SELECT md5(array_to_string(ARRAY(
+                SELECT
+                    'p {schema}.' || proname ||
+                    '(' || oidvectortypes(proargtypes) || ') ' ||
+                    format_type(prorettype, NULL) ||
+                    CASE WHEN proisagg THEN ' agg' ELSE '' END
+                FROM pg_proc
+                WHERE pronamespace = {schema_madlib_oid}
+                UNION ALL
+                SELECT 't {schema}.' || typname FROM pg_type
+                WHERE typnamespace = {schema_madlib_oid}
+                ORDER BY 1), ',')) AS fingerprint
+            """.format(schema=self._schema,
+                       schema_madlib_oid=self._schema_oid))[0]['fingerprint']
+
     """
     @brief Get the function name, return type, and arguments given an oid
     @note The function can only handle the case that proallargtypes is null,
@@ -81,18 +104,62 @@ class UpgradeBase:
                     oid = {oid}
             ) AS f
             """.format(oid=oid))
+        # NULL comes back as None from a database session
         return {"proname": row[0]['proname'], 'rettype': row[0]['rettype'],
-            'argument': row[0]['argument']}
+            'argument': row[0]['argument'] or ''}
+
+    """
+    @brief Get the function name, return type, and arguments for a list of
+    oids in a single catalog query
+    @return dictionary of oid to function info, see _get_function_info
+    """
+    def _get_functions_info(self, oids):
+        if len(oids) == 0:
+            return {}
+        rows = self._run_sql("""
+            SELECT
+                procoid,
+                max(proname) AS proname,
+                max(rettype) AS rettype,
+                array_to_string(
+                    array_agg(argname || ' ' || argtype order by i), ', ') AS argument
+            FROM
+            (
+                SELECT
+                    oid AS procoid,
+                    proname,
+                    textin(regtypeout(prorettype::regtype)) AS rettype,
+                    CASE array_upper(proargtypes,1) WHEN -1 THEN ''
+                        ELSE textin(regtypeout(unnest(proargtypes)::regtype))
+                    END AS argtype,
+                    CASE WHEN proargnames IS NULL THEN ''
+                        ELSE unnest(proargnames)
+                    END AS argname,
+                    CASE array_upper(proargtypes,1) WHEN -1 THEN 1
+                        ELSE generate_series(0, array_upper(proargtypes, 1))
+                    END AS i
+                FROM
+                    pg_proc AS p
+                WHERE
+                    oid IN ({oids})
+            ) AS f
+            GROUP BY
+                procoid
+            """.format(oids=','.join(str(oid) for oid in set(oids))))
+        res = {}
+        for row in rows:
+            res[str(row['procoid'])] = {"proname": row['proname'],
+                'rettype': row['rettype'], 'argument': row['argument'] or ''}
+        return res
 
 """
 @brief This class reads changes from the configuration file and handles
 the dropping of objects
 """
 class ChangeHandler(UpgradeBase):
-    def __init__(self, schema, portid, con_args, maddir, mad_dbrev):
+    def __init__(self, schema, portid, con_args, maddir, mad_dbrev, plan=None):
         UpgradeBase.__init__(self, schema, portid, con_args)
         self._opr_ind_svec = None
-        self._get_opr_indepent_svec()
         self._maddir = maddir
         self._mad_dbrev = mad_dbrev
         self._newmodule = None
@@ -100,7 +167,34 @@ class ChangeHandler(UpgradeBase):
         self._udf = None
         self._uda = None
         self._udc = None
-        self._load()
+        if plan is not None:
+            self._load_plan(plan)
+        else:
+            self._get_opr_indepent_svec()
+            self._load()
+
+    """
+    @brief Get the loaded changes for an upgrade plan
+    """
+    def get_plan(self):
+        return {'opr_ind_svec': self._opr_ind_svec,
+                'newmodule': self._newmodule,
+                'udt': self._udt,
+                'udf': dict(self._udf),
+                'uda': dict(self._uda),
+                'udc': self._udc}
+
+    """
+    @brief Load the changes from an upgrade plan instead of the changelist
+    and the catalog
+    """
+    def _load_plan(self, plan):
+        self._opr_ind_svec = plan['opr_ind_svec']
+        self._newmodule = plan['newmodule']
+        self._udt = plan['udt']
+        self._udf = defaultdict(list, plan['udf'])
+        self._uda = defaultdict(list, plan['uda'])
+        self._udc = plan['udc']
 
 
     """
@@ -314,19 +408,140 @@ class ChangeHandler(UpgradeBase):
 UDFs/UDAs defined in the current version
 """
 class ViewDependency(UpgradeBase):
-    def __init__(self, schema, portid, con_args):
+    def __init__(self, schema, portid, con_args, plan=None):
         UpgradeBase.__init__(self, schema, portid, con_args)
         self._view2proc = None
         self._view2view = None
         self._view2def = None
-        self._detect_direct_view_dependency()
-        self._detect_recursive_view_dependency()
+        if plan is not None:
+            self._load_plan(plan)
+        elif self._portid == 'postgres':
+            self._detect_view_dependency()
+        else:
+            # No recursive CTEs, fetch the whole view-on-view graph
+            self._detect_direct_view_dependency()
+            self._detect_recursive_view_dependency()
+        if plan is None:
+            self._view2proc = self._to_signatures(self._view2proc)
         self._filter_recursive_view_dependency()
 
+    """
+    @brief Get the dependency graph for an upgrade plan
+    """
+    def get_plan(self):
+        return {'view2proc': [[list(view), [list(proc) for proc in procs]]
+                              for (view, procs) in self._view2proc.items()],
+                'view2view': [[list(der), [list(dee) for dee in dees]]
+                              for (der, dees) in self._view2view.items()]}
+
+    """
+    @brief Load the dependency graph from an upgrade plan
+    """
+    def _load_plan(self, plan):
+        self._view2proc = defaultdict(list)
+        for (view, procs) in plan['view2proc']:
+            self._view2proc[tuple(view)] = [tuple(proc) for proc in procs]
+        self._view2view = defaultdict(list)
+        for (der, dees) in plan['view2view']:
+            self._view2view[tuple(der)] = [tuple(dee) for dee in dees]
+
+    """
+    @brief  Detect direct and recursive view dependencies on MADLib
+    UDFs/UDAs with a single recursive catalog query
+    @note Only the view-on-view edges between views depending (directly or
+    recursively) on MADlib UDFs/UDAs are returned
+    """
+    def _detect_view_dependency(self):
+        rows = self._run_sql("""
+            WITH RECURSIVE
+            view_proc AS (
+                SELECT DISTINCT
+                    rw.ev_class AS view,
+                    p.proname AS procname,
+                    p.oid AS procoid,
+                    p.proisagg AS proisagg
+                FROM
+                    pg_rewrite AS rw,
+                    pg_depend AS d,
+                    pg_proc AS p
+                WHERE
+                    rw.oid = d.objid AND
+                    d.classid = 'pg_rewrite'::regclass AND
+                    d.refclassid = 'pg_proc'::regclass AND
+                    d.refobjid = p.oid AND
+                    p.pronamespace = {schema_madlib_oid}
+            ),
+            view_view AS (
+                SELECT DISTINCT
+                    rw.ev_class AS depender,
+                    d.refobjid AS dependee
+                FROM
+                    pg_rewrite AS rw,
+                    pg_depend AS d,
+                    pg_class AS c
+                WHERE
+                    rw.oid = d.objid AND
+                    d.classid = 'pg_rewrite'::regclass AND
+                    d.refclassid = 'pg_class'::regclass AND
+                    d.refobjid = c.oid AND
+                    c.relkind = 'v' AND
+                    rw.ev_class <> d.refobjid
+            ),
+            affected (view) AS (
+                SELECT view FROM view_proc
+                UNION
+                SELECT vv.depender
+                FROM view_view AS vv, affected AS a
+                WHERE vv.dependee = a.view
+            )
+            SELECT
+                'proc' AS kind,
+                nsp.nspname AS schema, c.relname AS view,
+                vp.procname, vp.procoid, vp.proisagg,
+                NULL AS dependee_schema, NULL AS dependee
+            FROM
+                view_proc AS vp, pg_class AS c, pg_namespace AS nsp
+            WHERE
+                vp.view = c.oid AND c.relnamespace = nsp.oid
+            UNION ALL
+            SELECT
+                'view' AS kind,
+                nsp1.nspname AS schema, c1.relname AS view,
+                NULL, NULL, NULL,
+                nsp2.nspname AS dependee_schema, c2.relname AS dependee
+            FROM
+                view_view AS vv,
+                pg_class AS c1, pg_namespace AS nsp1,
+                pg_class AS c2, pg_namespace AS nsp2
+            WHERE
+                vv.dependee IN (SELECT view FROM affected) AND
+                vv.depender = c1.oid AND c1.relnamespace = nsp1.oid AND
+                vv.dependee = c2.oid AND c2.relnamespace = nsp2.oid
+        """.format(schema_madlib_oid=self._schema_oid))
+
+        self._view2proc = defaultdict(list)
+        self._view2view = defaultdict(list)
+        for row in rows:
+            key = (row['schema'], row['view'])
+            if row['kind'] == 'proc':
+                self._view2proc[key].append(
+                    (row['procname'], row['procoid'],
+                        row['proisagg'] in (True, 't')))
+            else:
+                self._view2view[key].append(
+                    (row['dependee_schema'], row['dependee']))
+
     """
     @brief  Detect direct view dependencies on MADLib UDFs/UDAs
     """
     def _detect_direct_view_dependency(self):
+        self._view2proc = self._get_direct_view_dependency()
+
+    """
+    @brief  Get direct view dependencies on MADLib UDFs/UDAs
+    @return dictionary of view to (procname, procoid, proisagg) tuples
+    """
+    def _get_direct_view_dependency(self):
         rows = self._run_sql("""
             SELECT
                 view, nsp.nspname AS schema, procname, procoid, proisagg
@@ -356,12 +571,30 @@ class ViewDependency(UpgradeBase):
                 t1.namespace = nsp.oid
         """.format(schema_madlib_oid=self._schema_oid))
 
-        self._view2proc = defaultdict(list)
+        view2proc = defaultdict(list)
         for row in rows:
             key= (row['schema'], row['view'])
-            self._view2proc[key].append(
+            view2proc[key].append(
                 (row['procname'], row['procoid'],
-                    True if row['proisagg'] == 't' else False))
+                    row['proisagg'] in (True, 't')))
+        return view2proc
+
+    """
+    @brief  Replace the oids of the depended UDFs/UDAs by their signatures,
+    which stay the same across databases with the same MADlib installation
+    @return dictionary of view to (procname, signature, proisagg) tuples
+    """
+    def _to_signatures(self, view2proc):
+        funcinfo = self._get_functions_info(
+            [proc[1] for procs in view2proc.values() for proc in procs])
+        res = defaultdict(list)
+        for (view, procs) in view2proc.items():
+            for (procname, procoid, isagg) in procs:
+                info = funcinfo[str(procoid)]
+                res[view].append((procname, get_signature_for_compare(
+                    self._schema, procname, info['rettype'], info['argument']),
+                    isagg))
+        return res
 
     """
     @brief  Detect recursive view dependencies (view on view)
@@ -414,27 +647,27 @@ class ViewDependency(UpgradeBase):
     MADLib UDFs/UDAs
     """
     def _filter_recursive_view_dependency(self):
-        # Get recursive dependee list
-        dependeelist = []
-        checklist = self._view2proc
-        while True:
-            dependeelist.extend(checklist.keys())
-            new_checklist = defaultdict(bool)
-            for depender in self._view2view.keys():
-                for dependee in self._view2view[depender]:
-                    if dependee in checklist:
-                        new_checklist[depender] = True
-                        break
-            if len(new_checklist) == 0:
-                break
-            else:
-                checklist = new_checklist
+        # Reverse the edges: dependee -> dependers
+        dee2der = defaultdict(set)
+        for depender in self._view2view:
+            for dependee in self._view2view[depender]:
+                dee2der[dependee].add(depender)
+
+        # Get recursive dependee set by traversing from the views depending
+        # on MADlib UDF/UDAs
+        dependees = set(self._view2proc.keys())
+        stack = list(dependees)
+        while stack:
+            for depender in dee2der.get(stack.pop(), ()):
+                if depender not in dependees:
+                    dependees.add(depender)
+                    stack.append(depender)
 
         # Filter recursive dependencies not related with MADLib UDF/UDAs
         fil_view2view = defaultdict(list)
         for depender in self._view2view:
             dependee = self._view2view[depender]
-            dependee = [r for r in dependee if r in dependeelist]
+            dependee = [r for r in dependee if r in dependees]
             if len(dependee) > 0:
                 fil_view2view[depender] = dependee
 
@@ -444,7 +677,10 @@ class ViewDependency(UpgradeBase):
     @brief  Build the dependency graph (depender-to-dependee adjacency list)
     """
     def _build_dependency_graph(self, hasProcDependency = False):
-        der2dee = self._view2view.copy()
+        # Copy the lists too, they are extended below
+        der2dee = defaultdict(list)
+        for view in self._view2view:
+            der2dee[view] = list(self._view2view[view])
         for view in self._view2proc:
             if view not in self._view2view:
                 der2dee[view] = []
@@ -458,6 +694,19 @@ class ViewDependency(UpgradeBase):
                     graph[dee] = []
         return graph
 
+    """
+    @brief Check whether the views directly depending on MADlib UDFs/UDAs in
+    the database are still the ones of the dependency graph, by view name and
+    signature of the depended UDFs/UDAs
+    @note Unlike the dependency detection, this is a single non-recursive
+    catalog query, so it is cheap enough to check a loaded upgrade plan
+    """
+    def same_direct_dependency(self):
+        def canonical(graph):
+            return dict((k, sorted(v)) for (k, v) in graph.items() if v)
+        direct = self._to_signatures(self._get_direct_view_dependency())
+        return canonical(self._view2proc) == canonical(direct)
+
     """
     @brief Check dependencies
     """
@@ -469,20 +718,27 @@ class ViewDependency(UpgradeBase):
     """
     def get_create_order_views(self):
         graph = self._build_dependency_graph()
+        # Number of dependees not created yet, and the reverse edges
+        n_dependee = {}
+        dee2der = defaultdict(list)
+        for depender in graph:
+            dependees = set(graph[depender])
+            n_dependee[depender] = len(dependees)
+            for dependee in dependees:
+                dee2der[dependee].append(depender)
+
+        # Create views level by level
         ordered_views = []
-        while True:
-            remove_list = []
-            for depender in graph:
-                if len(graph[depender]) == 0:
-                    ordered_views.append(depender)
-                    remove_list.append(depender)
-            for view in remove_list:
-                del graph[view]
-            for depender in graph:
-                graph[depender] = [r for r in graph[depender]
-                    if r not in remove_list]
-            if len(remove_list) == 0:
-                break
+        ready = [view for view in graph if n_dependee[view] == 0]
+        while ready:
+            ordered_views.extend(ready)
+            next_ready = []
+            for dependee in ready:
+                for depender in dee2der[dependee]:
+                    n_dependee[depender] -= 1
+                    if n_dependee[depender] == 0:
+                        next_ready.append(depender)
+            ready = next_ready
         return ordered_views
 
     """
@@ -500,44 +756,35 @@ class ViewDependency(UpgradeBase):
         res = {}
         for procs in self._view2proc.values():
             for proc in procs:
-                if proc[2] != isagg:
-                    continue
-                if (self._schema, proc) not in res:
-                    funcinfo = self._get_function_info(proc[1])
-                    signature = get_signature_for_compare(
-                        self._schema, proc[0], funcinfo['rettype'], funcinfo['argument'])
-                    res[signature] = True
+                if proc[2] == isagg:
+                    res[proc[1]] = True
         return res
 
     """
     @brief Get dependent UDAs
     """
     def get_depended_uda(self):
-        res = []
+        res = set()
         for procs in self._view2proc.values():
             for proc in procs:
                 if proc[2] == False:
                     # proc is not an aggregate -> skip
                     continue
-                if (self._schema, proc) not in res:
-                    res.append((self._schema, proc))
-        res.sort()
-        return res
+                res.add((self._schema, proc))
+        return sorted(res)
 
     """
     @brief Get dependent UDFs
     """
     def get_depended_udf(self):
-        res = []
+        res = set()
         for procs in self._view2proc.values():
             for proc in procs:
                 if proc[2] == True:
                     # proc is an aggregate -> skip
                     continue
-                if (self._schema, proc) not in res:
-                    res.append((self._schema, proc))
-        res.sort()
-        return res
+                res.add((self._schema, proc))
+        return sorted(res)
 
     """
     @brief Save and drop the dependent views
@@ -546,17 +793,18 @@ class ViewDependency(UpgradeBase):
         self._view2def = {}
         ordered_views = self.get_drop_order_views()
         # Save views
-        for view in ordered_views:
-            row = self._run_sql("""
+        if len(ordered_views) > 0:
+            rows = self._run_sql("""
                     SELECT
                         schemaname, viewname, viewowner, definition
                     FROM
                         pg_views
                     WHERE
-                        schemaname = '{schemaname}' AND
-                        viewname = '{viewname}'
-                    """.format(schemaname=view[0], viewname=view[1]))
-            self._view2def[view] = row[0]
+                        (schemaname, viewname) IN ({views})
+                    """.format(views=', '.join(
+                        "('%s', '%s')" % view for view in ordered_views)))
+            for row in rows:
+                self._view2def[(row['schemaname'], row['viewname'])] = row
 
         # Drop views
         for view in ordered_views:
@@ -591,8 +839,7 @@ class ViewDependency(UpgradeBase):
         if len(node) == 2:
             res = '%s.%s' % (node[0], node[1])
         else:
-            res = '%s.%s{oid=%s,isagg=%s}' % (
-                self._schema, node[0], node[1], node[2])
+            res = '%s{isagg=%s}' % (node[1], node[2])
         return res
 
     def _nodes_to_str(self, nodes):
@@ -687,14 +934,25 @@ class TableDependency(UpgradeBase):
 executed during the upgrade
 """
 class ScriptCleaner(UpgradeBase):
-    def __init__(self, schema, portid, con_args, change_handler):
+    def __init__(self, schema, portid, con_args, change_handler, plan=None):
         UpgradeBase.__init__(self, schema, portid, con_args)
-        self._sql = None
         self._existing_uda = None
         self._existing_udt = None
-        self._get_existing_uda()
-        self._get_existing_udt()
+        if plan is not None:
+            self._existing_uda = plan['existing_uda']
+            self._existing_udt = plan['existing_udt']
+        else:
+            self._get_existing_uda()
+            self._get_existing_udt()
         self._ch = change_handler
+        self._build_lookup_sets()
+
+    """
+    @brief Get the existing UDAs/UDTs for an upgrade plan
+    """
+    def get_plan(self):
+        return {'existing_uda': self._existing_uda,
+                'existing_udt': self._existing_udt}
 
     """
     @breif Get the existing UDAs in the current version
@@ -737,7 +995,7 @@ class ScriptCleaner(UpgradeBase):
                 self._existing_uda[row['proname']] = []
             self._existing_uda[row['proname']].append({
                 'rettype': ['rettype'],
-                'argument': row['argument']})
+                'argument': row['argument'] or ''})
 
     """
     @brief Get the existing UDTs in the current version
@@ -765,144 +1023,175 @@ class ScriptCleaner(UpgradeBase):
         return self._ch
 
     """
-    @brief Remove comments in the sql script
+    @brief Build the hash sets used to classify statements in the sql script
     """
-    def _clean_comment(self):
-        pattern = re.compile(r"""(/\*(.|[\r\n])*?\*/)|(--(.*|[\r\n]))""")
-        res = ''
-        lines = re.split(r'[\r\n]+', self._sql)
-        for line in lines:
-            tmp = line
-            if not tmp.strip().startswith("E'"):
-                line = re.sub(pattern, '', line)
-            res += line + '\n'
-        self._sql = res.strip()
-        #self._sql = re.sub(pattern, '', self._sql).strip()
-
-    """
-    @breif Remove "drop/create type" statements in the sql script
-    """
-    def _clean_type(self):
-        # remove 'drop type'
-        pattern = re.compile('DROP(\s+)TYPE(.*?);', re.DOTALL | re.IGNORECASE);
-        self._sql = re.sub(pattern, '', self._sql)
-
-        # remove 'create type'
-        udt_str = ''
-        for udt in self._existing_udt:
-            if udt in self._ch.get_udt():
-                continue
-            if udt_str == '':
-                udt_str += udt
-            else:
-                udt_str += '|' + udt
-        p_str = 'CREATE(\s+)TYPE(\s+)%s\.(%s)(.*?);' % (self._schema.upper(), udt_str)
-        pattern = re.compile(p_str, re.DOTALL | re.IGNORECASE);
-        self._sql = re.sub(pattern, '', self._sql)
+    def _build_lookup_sets(self):
+        # Existing UDTs which are not changed are not created again
+        self._udt_to_skip = set(udt.lower() for udt in self._existing_udt
+                                if udt not in self._ch.get_udt())
 
-    """
-    @brief Remove "drop/create cast" statements in the sql script
-    """
-    def _clean_cast(self):
-        # remove 'drop cast'
-        pattern = re.compile('DROP(\s+)CAST(.*?);', re.DOTALL | re.IGNORECASE);
-        self._sql = re.sub(pattern, '', self._sql)
+        # Existing UDAs which are not changed are not created again
+        changed_uda = set()
+        for uda in self._ch.get_uda():
+            for item in self._ch.get_uda()[uda]:
+                changed_uda.add((uda.lower(), self._normalize_args(item['argument'])))
+        self._uda_to_skip = set()
+        for uda in self._existing_uda:
+            for item in self._existing_uda[uda]:
+                key = (uda.lower(), self._normalize_args(item['argument']))
+                if key not in changed_uda:
+                    self._uda_to_skip.add(key)
 
-        # remove 'create cast'
-        udc_str = ''
+        # Only the changed UDCs are created again
+        self._udc_to_keep = set()
         for udc in self._ch.get_udc():
-            if udc_str == '':
-                udc_str += '%s\s+AS\s+%s' % (
-                    self._ch.get_udc()[udc]['sourcetype'], self._ch.get_udc()[udc]['targettype'])
+            self._udc_to_keep.add((
+                self._normalize_type(self._ch.get_udc()[udc]['sourcetype']),
+                self._normalize_type(self._ch.get_udc()[udc]['targettype'])))
+
+    _type_aliases = {
+        'int2': 'smallint',
+        'int': 'integer',
+        'int4': 'integer',
+        'int8': 'bigint',
+        'float8': 'double precision',
+        'float4': 'real',
+        'varchar': 'character varying',
+        'bool': 'boolean'
+    }
+
+    """
+    @brief Normalize a type name for comparison
+    """
+    def _normalize_type(self, typ):
+        typ = re.sub(r'\s+', ' ', typ.strip().lower().replace('"', ''))
+        typ = typ.replace('schema_madlib', self._schema)
+        typ = re.sub(r'\s*\[\s*\]', '[]', typ)
+        base = typ.rstrip('[]')
+        return self._type_aliases.get(base, base) + typ[len(base):]
+
+    """
+    @brief Normalize a comma separated argument type list for comparison
+    """
+    def _normalize_args(self, argument):
+        if argument is None or argument.strip() == '':
+            return ''
+        return ','.join(self._normalize_type(arg)
+                        for arg in argument.split(','))
+
+    _token_pattern = re.compile(r"""
+        (?P<comment>--[^\n]*|/\*.*?\*/)
+        | (?P<dollar>\$(?:[A-Za-z_][A-Za-z0-9_]*)?\$)
+        | (?P<estring>[eE]'(?:[^'\\]|\\.|'')*')
+        | (?P<string>'(?:[^']|'')*')
+        | (?P<ident>"(?:[^"]|"")*")
+        | (?P<semicolon>;)
+        """, re.DOTALL | re.VERBOSE)
+
+    """
+    @brief Split the sql script into statements in a single pass
+    Comments are removed, quoted strings, quoted identifiers and dollar-quoted
+    bodies are kept intact.
+    @return list of statements without the terminating semicolon
+    """
+    def _split_statements(self, sql):
+        statements = []
+        cur = []
+        pos = 0
+        n = len(sql)
+        while pos < n:
+            m = self._token_pattern.search(sql, pos)
+            if m is None:
+                cur.append(sql[pos:])
+                break
+            cur.append(sql[pos:m.start()])
+            kind = m.lastgroup
+            if kind == 'comment':
+                # Keep the line break of a line comment
+                cur.append('\n' if m.group().startswith('--') else ' ')
+                pos = m.end()
+            elif kind == 'semicolon':
+                statements.append(''.join(cur))
+                cur = []
+                pos = m.end()
+            elif kind == 'dollar':
+                end = sql.find(m.group(), m.end())
+                end = n if end < 0 else end + len(m.group())
+                cur.append(sql[m.start():end])
+                pos = end
             else:
-                udc_str += '|' + '%s\s+AS\s+%s' % (
-                    self._ch.get_udc()[udc]['sourcetype'], self._ch.get_udc()[udc]['targettype'])
-
-        pattern = re.compile('CREATE\s+CAST(.*?);', re.DOTALL | re.IGNORECASE)
-        if udc_str != '':
-            pattern = re.compile('CREATE\s+CAST\s*\(\s*(?!%s)(.*?);' % udc_str , re.DOTALL | re.IGNORECASE)
-        self._sql = re.sub(pattern, '', self._sql)
-
-    """
-    @brief Remove "drop/create operator" statements in the sql script
-    """
-    def _clean_operator(self):
-        # remove 'drop operator'
-        pattern = re.compile('DROP(\s+)OPERATOR(.*?);', re.DOTALL | re.IGNORECASE);
-        self._sql = re.sub(pattern, '', self._sql)
-
-        # remove 'create operator'
-        pattern = re.compile(r"""CREATE(\s+)OPERATOR(.*?);""", re.DOTALL | re.IGNORECASE);
-        self._sql = re.sub(pattern, '', self._sql)
-
-    """
-    @brief Rewrite the type
-    """
-    def _rewrite_type_in(self, arg):
-        type_mapper = {
-            'smallint':'(int2|smallint)',
-            'integer':'(int|int4|integer)',
-            'bigint':'(int8|bigint)',
-            'double precision':'(float8|double precision)',
-            'real':'(float4|real)',
-            'character varying':'(varchar|character varying)'
-        }
-        for typ in type_mapper:
-            arg = arg.replace(typ, type_mapper[typ])
-        return arg.replace('[', '\[').replace(']', '\]')
-
-    """
-    @brief Remove "drop/create aggregate" statements in the sql script
-    """
-    def _clean_aggregate(self):
-        # remove 'drop aggregate'
-        pattern = re.compile('DROP(\s+)AGGREGATE(.*?);', re.DOTALL | re.IGNORECASE);
-        self._sql = re.sub(pattern, '', self._sql)
-
-        # remove 'create aggregate'
-        uda_str = ''
-        for uda in self._existing_uda:
-            for item in self._existing_uda[uda]:
-                if uda in self._ch.get_uda():
-                    items = self._ch.get_uda()[uda]
-                    if item in items:
-                        continue
-                p_arg_str = ''
-                argument = item['argument']
-                args = argument.split(',')
-                for arg in args:
-                    arg = self._rewrite_type_in(arg.strip())
-                    if p_arg_str == '':
-                        p_arg_str += '%s\s*' % arg
-                    else:
-                        p_arg_str += ',\s*%s\s*' % arg
-                p_str = 'CREATE\s+(ORDERED\s)*\s*AGGREGATE\s+%s\.(%s)\s*\(\s*%s\)(.*?);' % (
-                    self._schema.upper(), uda, p_arg_str)
-                pattern = re.compile(p_str, re.DOTALL | re.IGNORECASE);
-                self._sql = re.sub(pattern, '', self._sql)
-
-    """
-    @brief Remove "drop function" statements and rewrite "create function"
-    statements in the sql script
-    @note We don't drop any function
-    """
-    def _clean_function(self):
-        # remove 'drop function'
-        pattern = re.compile(r"""DROP(\s+)FUNCTION(.*?);""", re.DOTALL | re.IGNORECASE);
-        self._sql = re.sub(pattern, '', self._sql)
-        # replace 'create function' with 'create or replace function'
-        pattern = re.compile(r"""CREATE(\s+)FUNCTION""", re.DOTALL | re.IGNORECASE);
-        self._sql = re.sub(pattern, 'CREATE OR REPLACE FUNCTION', self._sql)
+                cur.append(m.group())
+                pos = m.end()
+        statements.append(''.join(cur))
+        return [stmt.strip() for stmt in statements if stmt.strip() != '']
+
+    _create_type_pattern = re.compile(
+        r'CREATE\s+TYPE\s+([\w"]+)\.([\w"]+)', re.IGNORECASE)
+    _create_cast_pattern = re.compile(
+        r'CREATE\s+CAST\s*\(\s*(.*?)\s+AS\s+(.*?)\s*\)',
+        re.IGNORECASE | re.DOTALL)
+    _create_aggregate_pattern = re.compile(
+        r'CREATE\s+(?:ORDERED\s+)?AGGREGATE\s+([\w"]+)\.([\w"]+)\s*\((.*?)\)',
+        re.IGNORECASE | re.DOTALL)
+    _create_function_pattern = re.compile(
+        r'CREATE\s+FUNCTION', re.IGNORECASE)
+    _head_pattern = re.compile(
+        r'(CREATE|DROP)\s+(?:ORDERED\s+)?(TYPE|CAST|OPERATOR|AGGREGATE|FUNCTION)\b',
+        re.IGNORECASE)
+
+    """
+    @brief Decide whether to keep, drop or rewrite a single statement
+    @return the statement to run, or None if it should be dropped
+    """
+    def _clean_statement(self, stmt):
+        head = self._head_pattern.match(stmt)
+        if head is None:
+            return stmt
+        action = head.group(1).upper()
+        obj = head.group(2).upper()
+
+        # We don't drop any objects, changed ones are dropped beforehand
+        if action == 'DROP':
+            return None
+
+        if obj == 'TYPE':
+            m = self._create_type_pattern.match(stmt)
+            if m and m.group(1).replace('"', '').lower() == self._schema and \
+                    m.group(2).replace('"', '').lower() in self._udt_to_skip:
+                return None
+            return stmt
+
+        if obj == 'CAST':
+            m = self._create_cast_pattern.match(stmt)
+            if m and (self._normalize_type(m.group(1)),
+                      self._normalize_type(m.group(2))) in self._udc_to_keep:
+                return stmt
+            return None
+
+        if obj == 'OPERATOR':
+            return None
+
+        if obj == 'AGGREGATE':
+            m = self._create_aggregate_pattern.match(stmt)
+            if m and m.group(1).replace('"', '').lower() == self._schema and \
+                    (m.group(2).replace('"', '').lower(),
+                     self._normalize_args(m.group(3))) in self._uda_to_skip:
+                return None
+            return stmt
+
+        # FUNCTION
+        return self._create_function_pattern.sub(
+            'CREATE OR REPLACE FUNCTION', stmt, 1)
 
     """
     @brief Entry function for cleaning the sql script
+    The script is split into statements once, each statement is classified by
+    its leading keywords and looked up in the hash sets of existing objects.
     """
     def cleanup(self, sql):
-        self._sql = sql
-        self._clean_comment()
-        self._clean_type()
-        self._clean_cast()
-        self._clean_operator()
-        self._clean_aggregate()
-        self._clean_function()
-        return self._sql
+        res = []
+        for stmt in self._split_statements(sql):
+            stmt = self._clean_statement(stmt)
+            if stmt is not None:
+                res.append(stmt + ';\n')
+        return '\n'.join(res)
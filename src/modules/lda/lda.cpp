@@ -148,6 +148,139 @@ static int32_t __sum(ArrayHandle<int32_t> ah){
     return std::accumulate(array, array + size, 0);
 }
 
+/**
+ * A model is either dense or sparse. The dense model is a (voc_size + 1) x
+ * topic_num 2-D array holding the word topic counts followed by the corpus
+ * topic counts. The sparse model is a 1-D array storing the word topic counts
+ * in the compressed sparse row format:
+ *     <voc_size, topic_num,
+ *      corpus topic counts (topic_num),
+ *      row offsets (voc_size + 1),
+ *      topics of the non-zero counts (nnz),
+ *      non-zero counts (nnz)>
+ * where the non-zero counts of word w are at positions [offsets[w],
+ * offsets[w + 1]).
+ **/
+static const int32_t SPARSE_HEADER_SIZE = 2;
+
+/**
+ * @brief Check whether a model is in the sparse format
+ * @note The contents of a sparse model are checked by __check_sparse_model()
+ **/
+static bool __is_sparse_model(
+    const int32_t * model, size_t size, size_t dims, int32_t voc_size,
+    int32_t topic_num){
+    size_t fixed = SPARSE_HEADER_SIZE + topic_num + voc_size + 1;
+    if(dims != 1 || size < fixed)
+        return false;
+    if(model[0] != voc_size || model[1] != topic_num)
+        return false;
+    int32_t nnz = model[fixed - 1];
+    return nnz >= 0 && size == fixed + 2 * (size_t)nnz;
+}
+
+/**
+ * @brief Check the validity of the contents of a sparse model
+ **/
+static void __check_sparse_model(
+    const int32_t * model, int32_t voc_size, int32_t topic_num){
+    const int32_t * corpus_topic = model + SPARSE_HEADER_SIZE;
+    const int32_t * offsets = corpus_topic + topic_num;
+    const int32_t * topics = offsets + voc_size + 1;
+    const int32_t * counts = topics + offsets[voc_size];
+
+    if(*std::min_element(corpus_topic, corpus_topic + topic_num) < 0)
+        throw std::invalid_argument("invalid topic counts in model");
+    if(offsets[0] != 0)
+        throw std::invalid_argument("invalid row offsets in model");
+    for(int32_t w = 0; w < voc_size; w++){
+        if(offsets[w + 1] < offsets[w])
+            throw std::invalid_argument("invalid row offsets in model");
+    }
+    for(int32_t k = 0; k < offsets[voc_size]; k++){
+        if(topics[k] < 0 || topics[k] >= topic_num)
+            throw std::invalid_argument("invalid topics in model");
+        if(counts[k] <= 0)
+            throw std::invalid_argument("invalid topic counts in model");
+    }
+}
+
+/**
+ * @brief Check the validity of a model and tell whether it is sparse
+ **/
+static bool __check_model(
+    ArrayHandle<int32_t> model, int32_t voc_size, int32_t topic_num){
+    if(__is_sparse_model(
+            model.ptr(), model.size(), model.dims(), voc_size, topic_num)){
+        __check_sparse_model(model.ptr(), voc_size, topic_num);
+        return true;
+    }
+    if(model.size() != (size_t)((voc_size + 1) * topic_num))
+        throw std::invalid_argument(
+            "invalid dimension - model.size() != (voc_size + 1) * topic_num");
+    if(__min(model) < 0)
+        throw std::invalid_argument("invalid topic counts in model");
+    return false;
+}
+
+/**
+ * @brief Get the corpus topic counts of a model
+ **/
+static const int32_t * __corpus_topic(
+    const int32_t * model, bool sparse, int32_t voc_size, int32_t topic_num){
+    if(sparse)
+        return model + SPARSE_HEADER_SIZE;
+    return model + voc_size * topic_num;
+}
+
+/**
+ * @brief Get the topic counts of a word in a model
+ * @param buf   A buffer of topic_num elements for expanding a sparse row
+ * @return      The topic counts, either pointing into the dense model or
+ *              to buf
+ **/
+static const int32_t * __word_topic(
+    const int32_t * model, bool sparse, int32_t voc_size, int32_t topic_num,
+    int32_t wordid, int32_t * buf){
+    if(!sparse)
+        return model + wordid * topic_num;
+
+    const int32_t * offsets = model + SPARSE_HEADER_SIZE + topic_num;
+    const int32_t * topics = offsets + voc_size + 1;
+    const int32_t * counts = topics + offsets[voc_size];
+    memset(buf, 0, topic_num * sizeof(int32_t));
+    for(int32_t k = offsets[wordid]; k < offsets[wordid + 1]; k++)
+        buf[topics[k]] = counts[k];
+    return buf;
+}
+
+/**
+ * @brief Expand a sparse model into a zero-initialized dense buffer
+ **/
+static void __densify(
+    const int32_t * model, int32_t voc_size, int32_t topic_num,
+    int32_t * dense){
+    memcpy(
+        dense + voc_size * topic_num,
+        __corpus_topic(model, true, voc_size, topic_num),
+        topic_num * sizeof(int32_t));
+    const int32_t * offsets = model + SPARSE_HEADER_SIZE + topic_num;
+    const int32_t * topics = offsets + voc_size + 1;
+    const int32_t * counts = topics + offsets[voc_size];
+    for(int32_t w = 0; w < voc_size; w++)
+        for(int32_t k = offsets[w]; k < offsets[w + 1]; k++)
+            dense[w * topic_num + topics[k]] = counts[k];
+}
+
+/**
+ * @brief This structure defines the model cached across the calls of
+ * lda_gibbs_sample.
+ **/
+typedef struct __model_ctx{
+    bool sparse;
+    int32_t * model;
+} model_ctx;
+
 /**
  * @brief This function learns the topics of words in a document and is the
  * main step of a Gibbs sampling iteration. The word topic counts and
@@ -158,7 +291,7 @@ static int32_t __sum(ArrayHandle<int32_t> ah){
  * @param args[1]   The counts of each unique words
  * @param args[2]   The topic counts and topic assignments in the document
  * @param args[3]   The model (word topic counts and corpus topic
- *                  counts)
+ *                  counts), dense or sparse
  * @param args[4]   The Dirichlet parameter for per-document topic
  *                  multinomial, i.e. alpha
  * @param args[5]   The Dirichlet parameter for per-topic word
@@ -168,6 +301,8 @@ static int32_t __sum(ArrayHandle<int32_t> ah){
  * @param args[8]   The number of iterations (=1:training, >1:prediction)
  * @return          The updated topic counts and topic assignments for
  *                  the document
+ * @note A sparse model is expanded for training, where the counts are
+ * updated after each draw, and kept sparse for prediction.
  **/
 AnyType lda_gibbs_sample::run(AnyType & args)
 {
@@ -221,37 +356,54 @@ AnyType lda_gibbs_sample::run(AnyType & args)
             throw std::invalid_argument("invalid argument - the model \
             parameter should not be null for the first call");
         ArrayHandle<int32_t> model = args[3].getAs<ArrayHandle<int32_t> >();
-        if(model.size() != (size_t)((voc_size + 1) * topic_num))
-            throw std::invalid_argument(
-                "invalid dimension - model.size() != (voc_size + 1) * topic_num");
-        if(__min(model) < 0)
-            throw std::invalid_argument("invalid topic counts in model");
+        bool sparse = __check_model(model, voc_size, topic_num);
 
-        int32 * state = 
+        model_ctx * ctx =
+            static_cast<model_ctx *>(
+                MemoryContextAllocZero(
+                    args.getCacheMemoryContext(), sizeof(model_ctx)));
+        ctx->sparse = sparse && iter_num > 1;
+        size_t size = ctx->sparse ? model.size() : 
+            (size_t)((voc_size + 1) * topic_num);
+        ctx->model = 
             static_cast<int32 *>(
                 MemoryContextAllocZero(
                     args.getCacheMemoryContext(), 
-                    model.size() * sizeof(int32_t)));
-        memcpy(state, model.ptr(), model.size() * sizeof(int32_t));
-        args.setUserFuncContext(state);
+                    size * sizeof(int32_t)));
+        if(sparse && !ctx->sparse)
+            __densify(model.ptr(), voc_size, topic_num, ctx->model);
+        else
+            memcpy(ctx->model, model.ptr(), size * sizeof(int32_t));
+        args.setUserFuncContext(ctx);
     }
 
-    int32_t * state = static_cast<int32_t *>(args.getUserFuncContext());
-    if(NULL == state){
+    model_ctx * ctx = static_cast<model_ctx *>(args.getUserFuncContext());
+    if(NULL == ctx){
         throw std::runtime_error("args.mSysInfo->user_fctx is null");
     }
+    int32_t * state = ctx->model;
+    const int32_t * corpus_topic = 
+        __corpus_topic(state, ctx->sparse, voc_size, topic_num);
+    int32_t * word_topic_buf = NULL;
+    if(ctx->sparse){
+        word_topic_buf = new int32_t[topic_num];
+        if(!word_topic_buf)
+            throw std::runtime_error("out of memory");
+    }
 
     int32_t unique_word_count = words.size();
     for(int it = 0; it < iter_num; it++){
         int32_t word_index = topic_num;
         for(int32_t i = 0; i < unique_word_count; i++) {
             int32_t wordid = words[i];
+            const int32_t * word_topic = __word_topic(
+                state, ctx->sparse, voc_size, topic_num, wordid,
+                word_topic_buf);
             for(int32_t j = 0; j < counts[i]; j++){
                 int32_t topic = doc_topic[word_index];
                 int32_t retopic = __lda_gibbs_sample(
                     topic_num, topic, doc_topic.ptr(), 
-                    state + wordid * topic_num, 
-                    state + voc_size * topic_num, alpha, beta);
+                    word_topic, corpus_topic, alpha, beta);
                 doc_topic[word_index] = retopic;
                 doc_topic[topic]--;
                 doc_topic[retopic]++;
@@ -266,6 +418,7 @@ AnyType lda_gibbs_sample::run(AnyType & args)
             }
         }
     }
+    delete[] word_topic_buf;
     
     return doc_topic;
 }
@@ -396,6 +549,261 @@ AnyType lda_count_topic_prefunc::run(AnyType & args)
     return state1;
 }
 
+/**
+ * @brief This function computes the topic count changes of a document caused
+ * by a Gibbs sampling sweep. Only the words whose topic assignment changed
+ * are reported.
+ * @param args[0]   The unique words in the document
+ * @param args[1]   The counts of each unique word in the document
+ * @param args[2]   The topic counts and topic assignments before the sweep
+ * @param args[3]   The topic counts and topic assignments after the sweep
+ * @param args[4]   The number of topics
+ * @return          The changes as (wordid, old topic, new topic) triples in a
+ *                  1-d array, or NULL if no assignment changed
+ **/
+AnyType lda_topic_delta::run(AnyType & args)
+{
+    ArrayHandle<int32_t> words = args[0].getAs<ArrayHandle<int32_t> >();
+    ArrayHandle<int32_t> counts = args[1].getAs<ArrayHandle<int32_t> >();
+    ArrayHandle<int32_t> old_doc_topic = args[2].getAs<ArrayHandle<int32_t> >();
+    ArrayHandle<int32_t> new_doc_topic = args[3].getAs<ArrayHandle<int32_t> >();
+    int32_t topic_num = args[4].getAs<int32_t>();
+
+    if(topic_num <= 0)
+        throw std::invalid_argument(
+            "invalid argument - topic_num");
+    if(words.size() != counts.size())
+        throw std::invalid_argument(
+            "dimensions mismatch - words.size() != counts.size()");
+    if(old_doc_topic.size() != new_doc_topic.size())
+        throw std::invalid_argument(
+            "dimensions mismatch - old_doc_topic.size() != new_doc_topic.size()");
+    if(old_doc_topic.size() != (size_t)(__sum(counts) + topic_num))
+        throw std::invalid_argument(
+            "invalid dimension - doc_topic.size() != word_count + topic_num");
+
+    int32_t changed = 0;
+    for(size_t i = topic_num; i < old_doc_topic.size(); i++)
+        if(old_doc_topic[i] != new_doc_topic[i])
+            changed++;
+    if(changed == 0)
+        return Null();
+
+    MutableArrayHandle<int32_t> delta(
+        madlib_construct_array(
+            NULL, 3 * changed, INT4TI.oid, INT4TI.len, INT4TI.byval,
+            INT4TI.align));
+
+    int32_t unique_word_count = words.size();
+    int32_t word_index = topic_num;
+    int32_t k = 0;
+    for(int32_t i = 0; i < unique_word_count; i++){
+        for(int32_t j = 0; j < counts[i]; j++){
+            if(old_doc_topic[word_index] != new_doc_topic[word_index]){
+                delta[k++] = words[i];
+                delta[k++] = old_doc_topic[word_index];
+                delta[k++] = new_doc_topic[word_index];
+            }
+            word_index++;
+        }
+    }
+
+    return delta;
+}
+
+/**
+ * @brief This function is the sfunc for the aggregator summing up topic count
+ * changes. Unlike lda_count_topic_sfunc, it only visits the words whose topic
+ * assignment changed, and the resulting counts may be negative.
+ * @param args[0]   The state variable, current topic count changes
+ * @param args[1]   The changes of a document as returned by lda_topic_delta
+ * @param args[2]   The size of vocabulary
+ * @param args[3]   The number of topics
+ * @return          The updated state
+ **/
+AnyType lda_count_delta_sfunc::run(AnyType & args)
+{
+    if(args[2].isNull() || args[3].isNull())
+        throw std::invalid_argument("null parameter - voc_size and/or \
+        topic_num is null");
+
+    if(args[1].isNull())
+        return args[0];
+
+    int32_t voc_size = args[2].getAs<int32_t>();
+    int32_t topic_num = args[3].getAs<int32_t>();
+    if(voc_size <= 0)
+        throw std::invalid_argument(
+            "invalid argument - voc_size");
+    if(topic_num <= 0)
+        throw std::invalid_argument(
+            "invalid argument - topic_num");
+
+    ArrayHandle<int32_t> delta = args[1].getAs<ArrayHandle<int32_t> >();
+    if(delta.size() % 3 != 0)
+        throw std::invalid_argument(
+            "invalid dimension - delta.size() is not a multiple of 3");
+
+    MutableArrayHandle<int32_t> state(NULL);
+    if(args[0].isNull()){
+        int dims[2] = {voc_size + 1, topic_num};
+        int lbs[2] = {1, 1};
+        state = madlib_construct_md_array(
+            NULL, NULL, 2, dims, lbs, INT4TI.oid, INT4TI.len, INT4TI.byval,
+            INT4TI.align);
+    } else {
+        state = args[0].getAs<MutableArrayHandle<int32_t> >();
+    }
+
+    for(size_t i = 0; i < delta.size(); i += 3){
+        int32_t wordid = delta[i];
+        int32_t topic = delta[i + 1];
+        int32_t retopic = delta[i + 2];
+        if(wordid < 0 || wordid >= voc_size)
+            throw std::invalid_argument("invalid values in words");
+        if(topic < 0 || topic >= topic_num ||
+            retopic < 0 || retopic >= topic_num)
+            throw std::invalid_argument("invalid values in topics");
+        state[wordid * topic_num + topic]--;
+        state[wordid * topic_num + retopic]++;
+        state[voc_size * topic_num + topic]--;
+        state[voc_size * topic_num + retopic]++;
+    }
+
+    return state;
+}
+
+/**
+ * @brief This function applies summed topic count changes to a model.
+ * @param args[0]   The model (word topic counts and corpus topic counts)
+ * @param args[1]   The topic count changes, as computed by
+ *                  __lda_count_delta_agg
+ * @return          The updated model
+ **/
+AnyType lda_apply_delta::run(AnyType & args)
+{
+    if(args[1].isNull())
+        return args[0];
+    ArrayHandle<int32_t> model = args[0].getAs<ArrayHandle<int32_t> >();
+    ArrayHandle<int32_t> delta = args[1].getAs<ArrayHandle<int32_t> >();
+
+    if(model.dims() != 2)
+        throw std::invalid_argument("invalid dimension");
+    if(model.size() != delta.size())
+        throw std::invalid_argument(
+            "dimensions mismatch - model.size() != delta.size()");
+
+    int dims[2] = {static_cast<int>(model.sizeOfDim(0)),
+        static_cast<int>(model.sizeOfDim(1))};
+    int lbs[2] = {1, 1};
+    MutableArrayHandle<int32_t> updated(
+        madlib_construct_md_array(
+            NULL, NULL, 2, dims, lbs, INT4TI.oid, INT4TI.len, INT4TI.byval,
+            INT4TI.align));
+
+    for(size_t i = 0; i < model.size(); i++){
+        updated[i] = model[i] + delta[i];
+        if(updated[i] < 0)
+            throw std::runtime_error(
+                "invalid topic counts in model after applying delta");
+    }
+
+    return updated;
+}
+
+/**
+ * @brief This function converts a model into the sparse format
+ * @param args[0]   The model, dense or sparse
+ * @param args[1]   The size of vocabulary
+ * @param args[2]   The number of topics
+ * @return          The sparse model, or the model itself if it is already
+ *                  sparse
+ **/
+AnyType lda_sparsify::run(AnyType & args)
+{
+    ArrayHandle<int32_t> model = args[0].getAs<ArrayHandle<int32_t> >();
+    int32_t voc_size = args[1].getAs<int32_t>();
+    int32_t topic_num = args[2].getAs<int32_t>();
+    if(voc_size <= 0)
+        throw std::invalid_argument(
+            "invalid argument - voc_size");
+    if(topic_num <= 0)
+        throw std::invalid_argument(
+            "invalid argument - topic_num");
+
+    if(__check_model(model, voc_size, topic_num))
+        return args[0];
+
+    int32_t nnz = 0;
+    for(int32_t i = 0; i < voc_size * topic_num; i++)
+        if(model[i] != 0)
+            nnz++;
+
+    MutableArrayHandle<int32_t> sparse(
+        madlib_construct_array(
+            NULL, SPARSE_HEADER_SIZE + topic_num + voc_size + 1 + 2 * nnz,
+            INT4TI.oid, INT4TI.len, INT4TI.byval, INT4TI.align));
+    sparse[0] = voc_size;
+    sparse[1] = topic_num;
+    int32_t * corpus_topic = sparse.ptr() + SPARSE_HEADER_SIZE;
+    int32_t * offsets = corpus_topic + topic_num;
+    int32_t * topics = offsets + voc_size + 1;
+    int32_t * counts = topics + nnz;
+
+    memcpy(
+        corpus_topic, model.ptr() + voc_size * topic_num,
+        topic_num * sizeof(int32_t));
+    int32_t k = 0;
+    for(int32_t w = 0; w < voc_size; w++){
+        offsets[w] = k;
+        for(int32_t z = 0; z < topic_num; z++){
+            int32_t count = model[w * topic_num + z];
+            if(count != 0){
+                topics[k] = z;
+                counts[k] = count;
+                k++;
+            }
+        }
+    }
+    offsets[voc_size] = k;
+
+    return sparse;
+}
+
+/**
+ * @brief This function converts a model into the dense format
+ * @param args[0]   The model, dense or sparse
+ * @param args[1]   The size of vocabulary
+ * @param args[2]   The number of topics
+ * @return          The (voc_size + 1) x topic_num dense model, or the model
+ *                  itself if it is already dense
+ **/
+AnyType lda_densify::run(AnyType & args)
+{
+    ArrayHandle<int32_t> model = args[0].getAs<ArrayHandle<int32_t> >();
+    int32_t voc_size = args[1].getAs<int32_t>();
+    int32_t topic_num = args[2].getAs<int32_t>();
+    if(voc_size <= 0)
+        throw std::invalid_argument(
+            "invalid argument - voc_size");
+    if(topic_num <= 0)
+        throw std::invalid_argument(
+            "invalid argument - topic_num");
+
+    if(!__check_model(model, voc_size, topic_num))
+        return args[0];
+
+    int dims[2] = {voc_size + 1, topic_num};
+    int lbs[2] = {1, 1};
+    MutableArrayHandle<int32_t> dense(
+        madlib_construct_md_array(
+            NULL, NULL, 2, dims, lbs, INT4TI.oid, INT4TI.len, INT4TI.byval,
+            INT4TI.align));
+    __densify(model.ptr(), voc_size, topic_num, dense.ptr());
+
+    return dense;
+}
+
 /**
  * @brief This function transposes a matrix represented by a 2-D array
  * @param args[0]   The input matrix
@@ -491,14 +899,15 @@ AnyType lda_unnest::SRF_next(void *user_fctx, bool *is_last_call)
  * @param args[2]   The counts of each unique words
  * @param args[3]   The topic counts in the document
  * @param args[4]   The model (word topic counts and corpus topic
- *                  counts)
+ *                  counts), dense or sparse
  * @param args[5]   The Dirichlet parameter for per-document topic
  *                  multinomial, i.e. alpha
  * @param args[6]   The Dirichlet parameter for per-topic word
  *                  multinomial, i.e. beta
  * @param args[7]   The size of vocabulary
  * @param args[8]   The number of topics
- * @return          The updated state 
+ * @return          The updated state, in the form of <sparse flag, model,
+ *                  perplexity (as a double)>
  **/
 AnyType lda_perplexity_sfunc::run(AnyType & args){
     ArrayHandle<int32_t> words = args[1].getAs<ArrayHandle<int32_t> >();
@@ -542,24 +951,29 @@ AnyType lda_perplexity_sfunc::run(AnyType & args){
             throw std::invalid_argument("invalid argument - the model \
             parameter should not be null for the first call");
         ArrayHandle<int32_t> model = args[4].getAs<ArrayHandle<int32_t> >();
-
-        if(model.size() != (size_t)((voc_size + 1) * topic_num))
-            throw std::invalid_argument(
-                "invalid dimension - model.size() != (voc_size + 1) * topic_num");
-        if(__min(model) < 0)
-            throw std::invalid_argument("invalid topic counts in model");
+        bool sparse = __check_model(model, voc_size, topic_num);
 
         state =  madlib_construct_array(
-            NULL, model.size() + 2, INT4TI.oid, INT4TI.len, INT4TI.byval,
+            NULL, model.size() + 3, INT4TI.oid, INT4TI.len, INT4TI.byval,
             INT4TI.align);
 
-        memcpy(state.ptr(), model.ptr(),  model.size() * sizeof(int32_t));
+        state[0] = sparse ? 1 : 0;
+        memcpy(state.ptr() + 1, model.ptr(),  model.size() * sizeof(int32_t));
     }else{
         state = args[0].getAs<MutableArrayHandle<int32_t> >();
     }
 
-    int32 * model = state.ptr();
+    bool sparse = (state[0] != 0);
+    const int32 * model = state.ptr() + 1;
+    const int32_t * corpus_topic =
+        __corpus_topic(model, sparse, voc_size, topic_num);
     double * perp = reinterpret_cast<double *>(state.ptr() + state.size() - 2);
+    int32_t * word_topic_buf = NULL;
+    if(sparse){
+        word_topic_buf = new int32_t[topic_num];
+        if(!word_topic_buf)
+            throw std::runtime_error("out of memory");
+    }
 
     int32_t n_d = 0;
     for(size_t i = 0; i < words.size(); i++){
@@ -569,12 +983,14 @@ AnyType lda_perplexity_sfunc::run(AnyType & args){
     for(size_t i = 0; i < words.size(); i++){
         int32_t w = words[i];
         int32_t n_dw = counts[i];
+        const int32_t * word_topic = __word_topic(
+            model, sparse, voc_size, topic_num, w, word_topic_buf);
 
         double sum_p = 0.0;
         for(int32_t z = 0; z < topic_num; z++){
                 int32_t n_dz = topic_counts[z];
-                int32_t n_wz = model[w * topic_num + z];
-                int32_t n_z = model[voc_size * topic_num + z];
+                int32_t n_wz = word_topic[z];
+                int32_t n_z = corpus_topic[z];
                 sum_p += (n_wz + beta) * (n_dz + alpha)
                             / (n_z + voc_size * beta); 
         }
@@ -582,6 +998,7 @@ AnyType lda_perplexity_sfunc::run(AnyType & args){
 
         *perp += n_dw * log(sum_p);
     }
+    delete[] word_topic_buf;
     
     return state;
 }
@@ -12,6 +12,13 @@ DECLARE_UDF(lda, lda_gibbs_sample)
 DECLARE_UDF(lda, lda_count_topic_sfunc)
 DECLARE_UDF(lda, lda_count_topic_prefunc)
 
+DECLARE_UDF(lda, lda_topic_delta)
+DECLARE_UDF(lda, lda_count_delta_sfunc)
+DECLARE_UDF(lda, lda_apply_delta)
+
+DECLARE_UDF(lda, lda_sparsify)
+DECLARE_UDF(lda, lda_densify)
+
 DECLARE_UDF(lda, lda_transpose)
 DECLARE_SR_UDF(lda, lda_unnest)
 
@@ -0,0 +1,292 @@
+/* ----------------------------------------------------------------------- *//**
+ *
+ * @file correlation.cpp
+ *
+ * @brief Correlation and covariance matrices computed in a single pass
+ *
+ *//* ----------------------------------------------------------------------- */
+
+#include <dbconnector/dbconnector.hpp>
+#include <modules/shared/HandleTraits.hpp>
+
+#include <limits>
+
+#include "correlation.hpp"
+
+namespace madlib {
+
+// Use Eigen
+using namespace dbal::eigen_integration;
+
+namespace modules {
+
+namespace stats {
+
+/**
+ * @brief Transition state for the correlations between two blocks of columns
+ *
+ * The state holds the sums over the rows without NULL values in the first
+ * widthOfX elements (block X) and the second widthOfY elements (block Y).
+ * Rows with NULL values only contribute to the pairs of non-NULL values, as
+ * in the corr() aggregate, and are accumulated pair by pair.
+ *
+ * Note: We assume that the DOUBLE PRECISION array is initialized by the
+ * database with length 5, and all elements are 0. Handle::operator[] will
+ * perform bounds checking.
+ */
+template <class Handle>
+class CorrelationState {
+    template <class OtherHandle>
+    friend class CorrelationState;
+
+public:
+    CorrelationState(const AnyType &inArray)
+        : mStorage(inArray.getAs<Handle>()) {
+
+        rebind(static_cast<uint32_t>(mStorage[1]),
+            static_cast<uint32_t>(mStorage[2]));
+    }
+
+    operator AnyType() const {
+        return mStorage;
+    }
+
+    void initialize(const Allocator &inAllocator, uint32_t inWidthOfX,
+        uint32_t inWidthOfY) {
+
+        mStorage = inAllocator.allocateArray<double, dbal::AggregateContext,
+            dbal::DoZero, dbal::ThrowBadAlloc>(
+                arraySize(inWidthOfX, inWidthOfY));
+        rebind(inWidthOfX, inWidthOfY);
+        widthOfX = inWidthOfX;
+        widthOfY = inWidthOfY;
+    }
+
+    template <class OtherHandle>
+    CorrelationState &operator+=(
+        const CorrelationState<OtherHandle> &inOtherState) {
+
+        if (mStorage.size() != inOtherState.mStorage.size() ||
+            widthOfX != inOtherState.widthOfX ||
+            widthOfY != inOtherState.widthOfY)
+            throw std::logic_error("Internal error: Incompatible transition "
+                "states");
+
+        numRows += inOtherState.numRows;
+        for (size_t i = 3; i < mStorage.size(); i++)
+            mStorage[i] += inOtherState.mStorage[i];
+        return *this;
+    }
+
+private:
+    static inline size_t arraySize(uint32_t inWidthOfX, uint32_t inWidthOfY) {
+        return 4 + 2 * static_cast<size_t>(inWidthOfX + inWidthOfY)
+            + 6 * static_cast<size_t>(inWidthOfX) * inWidthOfY;
+    }
+
+    /**
+     * @brief Rebind to a new storage array
+     *
+     * @param inWidthOfX The number of columns in block X
+     * @param inWidthOfY The number of columns in block Y
+     *
+     * Array layout:
+     * - 0: numRows (number of rows without NULL values)
+     * - 1: widthOfX (number of columns in block X)
+     * - 2: widthOfY (number of columns in block Y)
+     * - 3: numPartialRows (number of rows with NULL values)
+     * - 4: sumX (sums of block X over the rows without NULL values)
+     * - 4 + widthOfX: sumXSquared
+     * - 4 + 2 * widthOfX: sumY
+     * - 4 + 2 * widthOfX + widthOfY: sumYSquared
+     * - 4 + 2 * (widthOfX + widthOfY): crossProduct (widthOfX x widthOfY
+     *   matrix of the sums of x_i * y_j over all rows)
+     * - followed by five widthOfX x widthOfY matrices over the rows with
+     *   NULL values, counting only the rows where both x_i and y_j are not
+     *   NULL: pairCount, pairSumX, pairSumXSquared, pairSumY, pairSumYSquared
+     */
+    void rebind(uint32_t inWidthOfX, uint32_t inWidthOfY) {
+        size_t pos = 4;
+        size_t blockSize = static_cast<size_t>(inWidthOfX) * inWidthOfY;
+
+        numRows.rebind(&mStorage[0]);
+        widthOfX.rebind(&mStorage[1]);
+        widthOfY.rebind(&mStorage[2]);
+        numPartialRows.rebind(&mStorage[3]);
+        sumX.rebind(&mStorage[pos], inWidthOfX);
+        pos += inWidthOfX;
+        sumXSquared.rebind(&mStorage[pos], inWidthOfX);
+        pos += inWidthOfX;
+        sumY.rebind(&mStorage[pos], inWidthOfY);
+        pos += inWidthOfY;
+        sumYSquared.rebind(&mStorage[pos], inWidthOfY);
+        pos += inWidthOfY;
+        crossProduct.rebind(&mStorage[pos], inWidthOfX, inWidthOfY);
+        pos += blockSize;
+        pairCount.rebind(&mStorage[pos], inWidthOfX, inWidthOfY);
+        pos += blockSize;
+        pairSumX.rebind(&mStorage[pos], inWidthOfX, inWidthOfY);
+        pos += blockSize;
+        pairSumXSquared.rebind(&mStorage[pos], inWidthOfX, inWidthOfY);
+        pos += blockSize;
+        pairSumY.rebind(&mStorage[pos], inWidthOfX, inWidthOfY);
+        pos += blockSize;
+        pairSumYSquared.rebind(&mStorage[pos], inWidthOfX, inWidthOfY);
+
+        madlib_assert(mStorage.size() >= arraySize(inWidthOfX, inWidthOfY),
+            std::runtime_error("Out-of-bounds array access detected."));
+    }
+
+    Handle mStorage;
+
+public:
+    typename HandleTraits<Handle>::ReferenceToUInt64 numRows;
+    typename HandleTraits<Handle>::ReferenceToUInt32 widthOfX;
+    typename HandleTraits<Handle>::ReferenceToUInt32 widthOfY;
+    typename HandleTraits<Handle>::ReferenceToUInt64 numPartialRows;
+    typename HandleTraits<Handle>::ColumnVectorTransparentHandleMap sumX;
+    typename HandleTraits<Handle>::ColumnVectorTransparentHandleMap sumXSquared;
+    typename HandleTraits<Handle>::ColumnVectorTransparentHandleMap sumY;
+    typename HandleTraits<Handle>::ColumnVectorTransparentHandleMap sumYSquared;
+    typename HandleTraits<Handle>::MatrixTransparentHandleMap crossProduct;
+    typename HandleTraits<Handle>::MatrixTransparentHandleMap pairCount;
+    typename HandleTraits<Handle>::MatrixTransparentHandleMap pairSumX;
+    typename HandleTraits<Handle>::MatrixTransparentHandleMap pairSumXSquared;
+    typename HandleTraits<Handle>::MatrixTransparentHandleMap pairSumY;
+    typename HandleTraits<Handle>::MatrixTransparentHandleMap pairSumYSquared;
+};
+
+/**
+ * @brief Transition function for the correlations between two blocks
+ *
+ * Arguments (Matched with PSQL wrapped)
+ * - 0: Current State
+ * - 1: x (block X, with NULL values replaced by 0)
+ * - 2: y (block Y, with NULL values replaced by 0). NULL if block Y is
+ *      block X.
+ * - 3: NULL indicators of x (1 for a NULL value). NULL if x has no NULL
+ *      value.
+ * - 4: NULL indicators of y. NULL if y has no NULL value.
+ */
+AnyType
+correlation_transition::run(AnyType& args) {
+    CorrelationState<MutableArrayHandle<double> > state = args[0];
+    bool sameBlock = args[2].isNull();
+    MappedColumnVector x = args[1].getAs<MappedColumnVector>();
+    MappedColumnVector y = args[sameBlock ? 1 : 2].getAs<MappedColumnVector>();
+    bool xHasNull = !args[3].isNull();
+    bool yHasNull = !args[sameBlock ? 3 : 4].isNull();
+
+    if (state.widthOfX == 0)
+        state.initialize(*this, static_cast<uint32_t>(x.size()),
+            static_cast<uint32_t>(y.size()));
+    else if (x.size() != state.sumX.size() || y.size() != state.sumY.size())
+        throw std::invalid_argument("Invalid arguments: Dimensions of vectors "
+            "not consistent.");
+
+    // NULL values are 0 in x and y, so they do not add to the cross products
+    state.crossProduct.noalias() += x * trans(y);
+    if (!xHasNull && !yHasNull) {
+        state.numRows++;
+        state.sumX += x;
+        state.sumXSquared += x.cwiseProduct(x);
+        state.sumY += y;
+        state.sumYSquared += y.cwiseProduct(y);
+        return state;
+    }
+
+    ColumnVector xPresent = ColumnVector::Ones(x.size());
+    if (xHasNull)
+        xPresent -= args[3].getAs<MappedColumnVector>();
+    ColumnVector yPresent = ColumnVector::Ones(y.size());
+    if (yHasNull)
+        yPresent -= args[sameBlock ? 3 : 4].getAs<MappedColumnVector>();
+
+    state.numPartialRows++;
+    state.pairCount.noalias() += xPresent * trans(yPresent);
+    state.pairSumX.noalias() += x * trans(yPresent);
+    state.pairSumXSquared.noalias() += x.cwiseProduct(x) * trans(yPresent);
+    state.pairSumY.noalias() += xPresent * trans(y);
+    state.pairSumYSquared.noalias() += xPresent * trans(y.cwiseProduct(y));
+    return state;
+}
+
+/**
+ * @brief Merge function for the correlations between two blocks
+ */
+AnyType
+correlation_merge_states::run(AnyType& args) {
+    CorrelationState<MutableArrayHandle<double> > stateLeft = args[0];
+    CorrelationState<ArrayHandle<double> > stateRight = args[1];
+
+    // We first handle the trivial case where this function is called with one
+    // of the states being the initial state
+    if (stateLeft.widthOfX == 0)
+        return stateRight;
+    else if (stateRight.widthOfX == 0)
+        return stateLeft;
+
+    stateLeft += stateRight;
+    return stateLeft;
+}
+
+/**
+ * @brief Final function for the correlations between two blocks
+ *
+ * Returns the correlations of all pairs (x_i, y_j) in row-major order,
+ * followed by their sample covariances in the same order. Both are computed
+ * as in the corr() and covar_samp() aggregates over the rows where x_i and
+ * y_j are not NULL, and are NaN where these aggregates return NULL.
+ */
+AnyType
+correlation_final::run(AnyType& args) {
+    CorrelationState<ArrayHandle<double> > state = args[0];
+
+    // If we haven't seen any data, just return Null.
+    if (state.widthOfX == 0)
+        return Null();
+
+    Index widthOfX = state.sumX.size();
+    Index widthOfY = state.sumY.size();
+    double numRows = static_cast<double>(state.numRows);
+    bool hasPartialRows = (state.numPartialRows > 0);
+    const double nan = std::numeric_limits<double>::quiet_NaN();
+
+    MutableNativeColumnVector result(
+        this->allocateArray<double>(2 * widthOfX * widthOfY));
+    for (Index i = 0; i < widthOfX; i++) {
+        for (Index j = 0; j < widthOfY; j++) {
+            double n = numRows;
+            double sumX = state.sumX(i);
+            double sumXSquared = state.sumXSquared(i);
+            double sumY = state.sumY(j);
+            double sumYSquared = state.sumYSquared(j);
+            if (hasPartialRows) {
+                n += state.pairCount(i, j);
+                sumX += state.pairSumX(i, j);
+                sumXSquared += state.pairSumXSquared(i, j);
+                sumY += state.pairSumY(i, j);
+                sumYSquared += state.pairSumYSquared(i, j);
+            }
+
+            double numeratorX = n * sumXSquared - sumX * sumX;
+            double numeratorY = n * sumYSquared - sumY * sumY;
+            double numeratorXY = n * state.crossProduct(i, j) - sumX * sumY;
+            Index pos = i * widthOfY + j;
+
+            result(pos) = (n < 1 || numeratorX <= 0 || numeratorY <= 0)
+                ? nan
+                : numeratorXY / std::sqrt(numeratorX * numeratorY);
+            result(widthOfX * widthOfY + pos) = (n < 2)
+                ? nan
+                : numeratorXY / (n * (n - 1));
+        }
+    }
+    return result;
+}
+
+} // namespace stats
+
+} // namespace modules
+
+} // namespace madlib
@@ -0,0 +1,20 @@
+/* ----------------------------------------------------------------------- *//**
+ *
+ * @file correlation.hpp
+ *
+ *//* ----------------------------------------------------------------------- */
+
+/**
+ * @brief Correlation and covariance of two blocks of columns: Transition function
+ */
+DECLARE_UDF(stats, correlation_transition)
+
+/**
+ * @brief Correlation and covariance of two blocks of columns: State merge function
+ */
+DECLARE_UDF(stats, correlation_merge_states)
+
+/**
+ * @brief Correlation and covariance of two blocks of columns: Final function
+ */
+DECLARE_UDF(stats, correlation_final)
@@ -7,6 +7,7 @@
  * -------------------------------------------------------------------------- */
 
 #include "chi_squared_test.hpp"
+#include "correlation.hpp"
 #include "kolmogorov_smirnov_test.hpp"
 #include "mann_whitney_test.hpp"
 #include "one_way_anova.hpp"